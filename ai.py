@@ -1,43 +1,67 @@
 from collections import defaultdict
-
-from rank import Rank, beats, beaten_by
-from random import shuffle, randint
-from gog import player_pieces, Piece, BoardManager
+from functools import lru_cache
+
+from rank import Rank, WIN, DRAW, LOSS, DUEL_MASKS, CHALLENGER_MASKS
+from concurrent.futures import ProcessPoolExecutor
+from random import randint, getrandbits, Random
+import random
+from gog import player_pieces, PIECES_PER_PLAYER, first_piece_id
+import compact
+import zobrist
+from beliefs import Beliefs, BEATS_MASK, BEATEN_BY_MASK, FLAG_BIT, COUNTS, MASK_WEIGHTS
+from sampler import DeterminizationSampler
+import book
+from rollout import ROLLOUT_POLICIES, Cutoff, cutoff_victor
+from compact import CompactBoardManager
+from topology import NEIGHBOR_POSITIONS
 import math
+import time
 
 
-def generate_random_init_form():
+def generate_random_init_form(rng=random):
     form = []
     for rank, n in player_pieces.items():
         for _ in range(n):
             form.append(rank)
     for _ in range(6):
         form.append(None)
-    shuffle(form)
+    rng.shuffle(form)
     form = [form[9 * i: 9 * (i + 1)] for i in range(3)]
     return form
 
 
-move_dirs = ((0, 1), (1, 0), (-1, 0), (0, -1))
+def _occupied_squares(pov, player):
+    return {(i, j) for i, row in enumerate(pov) for j, square in enumerate(row)
+            if square is not None and square.player == player}
+
 
+# keeps the squares of player's pieces up to date once move has been played on pov
+def _update_occupied(occupied, pov, player, move):
+    src, dst = (move[0][0], move[0][1]), (move[1][0], move[1][1])
+    occupied.discard(src)
+    square = pov[dst[0]][dst[1]]
+    if square is not None and square.player == player:
+        occupied.add(dst)
+    else:
+        occupied.discard(dst)
 
-def _generate_valid_moves(pov, player):
-    def is_valid_destination(row_num, col_num):
-        return 0 <= row_num < 8 and 0 <= col_num < 9 and (pov[row_num][col_num] is None
-                                                          or pov[row_num][col_num].player != player)
 
+# occupied are the squares of player's pieces if they are kept, otherwise the pov is scanned for them
+def _generate_valid_moves(pov, player, occupied=None):
+    if occupied is None:
+        occupied = [(i, j) for i, row in enumerate(pov) for j, square in enumerate(row)
+                    if square is not None and square.player == player]
     valid_moves = []
-    for i, row in enumerate(pov):
-        for j, square in enumerate(row):
-            if square is not None and square.player == player:
-                for move_dir in move_dirs:
-                    if is_valid_destination(i + move_dir[0], j + move_dir[1]):
-                        valid_moves.append(((i, j), (i + move_dir[0], j + move_dir[1])))
+    for src in occupied:
+        for dst in NEIGHBOR_POSITIONS[src[0]][src[1]]:
+            square = pov[dst[0]][dst[1]]
+            if square is None or square.player != player:
+                valid_moves.append((src, dst))
     return valid_moves
 
 
-def _get_random_move(pov, player):
-    valid_moves = _generate_valid_moves(pov, player)
+def _get_random_move(pov, player, occupied=None):
+    valid_moves = _generate_valid_moves(pov, player, occupied)
     if len(valid_moves) == 0:
         return None
     m = valid_moves[randint(0, len(valid_moves) - 1)]
@@ -48,9 +72,13 @@ class AI:
     def __init__(self, player):
         self._player = player
         self._pov = None
+        self._occupied = None
 
+    # the squares of the AI's own pieces are kept from here on from the board events, so that its move generation
+    # does not scan the board
     def set_pov(self, pov):
         self._pov = pov
+        self._occupied = _occupied_squares(pov, self._player)
 
     def get_init_form(self):
         raise NotImplementedError()
@@ -70,24 +98,18 @@ class AIRandom(AI):
         return generate_random_init_form()
 
     def board_event(self, event):
-        return
+        if event:
+            _update_occupied(self._occupied, self._pov, self._player, event[0])
 
     def enemy_set_pieces(self):
         return
 
     def get_move(self):
         assert self._pov
-        return _get_random_move(self._pov, self._player)
-
-
-def _duel_dict_copy(duel_dict):
-    copy = {}
-    for key, value in duel_dict.items():
-        copy[key] = value.copy()
-    return copy
+        return _get_random_move(self._pov, self._player, self._occupied)
 
 
-def _update_possibilities(self, event):
+def _update_beliefs(self, event):
     eliminated_pieces = event[1]
     if not eliminated_pieces:
         return
@@ -95,296 +117,591 @@ def _update_possibilities(self, event):
     if len(eliminated_pieces) == 2:
         own_piece = eliminated_pieces[0] if eliminated_pieces[0].player == self._player else eliminated_pieces[1]
         enemy_piece = eliminated_pieces[0] if eliminated_pieces[0].player != self._player else eliminated_pieces[1]
-        for rank in self._possible_ranks_per_piece[enemy_piece]:
-            if rank == own_piece.rank: continue
-            self._possible_pieces_per_rank[rank].remove(enemy_piece)
-        self._possible_ranks_per_piece[enemy_piece] = {own_piece.rank}
+        self._beliefs.piece_is(enemy_piece.id - self._enemy_base, own_piece.rank)
     else:
         enemy_piece = eliminated_pieces[0] if eliminated_pieces[0].player != self._player else \
             self._pov[move[1][0]][move[1][1]]
         own_piece = eliminated_pieces[0] if eliminated_pieces[0].player == self._player else \
             self._pov[move[1][0]][move[1][1]]
-        duel_dict = beats if enemy_piece is eliminated_pieces[0] else beaten_by
-        enemy_piece_cannot_be = duel_dict[own_piece.rank] | {own_piece.rank}
-        for rank in enemy_piece_cannot_be:
-            if rank in self._possible_ranks_per_piece[enemy_piece]:
-                self._possible_pieces_per_rank[rank].remove(enemy_piece)
-        self._possible_ranks_per_piece[enemy_piece] -= enemy_piece_cannot_be
-        self._possible_ranks_per_piece[enemy_piece].discard(Rank.FLAG)
-
-    _clean_possibilities(self)
-
-
-def _clean_possibilities(self):
-    modified = True
-    while modified:
-        modified = False
-        for piece, ranks in self._possible_ranks_per_piece.items():
-            if len(ranks) == 1:
-                for rank in ranks:
-                    modified = _update_pieces_from_clean(self, rank)
-                if modified: break
-        for rank, pieces in self._possible_pieces_per_rank.items():
-            if (rank != Rank.PRIVATE and rank != Rank.SPY and len(pieces) == 1) or (rank == Rank.PRIVATE and
-                                                                                    len(pieces) == 6) \
-                    or (rank == Rank.SPY and len(pieces) == 2):
-                modified = modified or _update_ranks_from_clean(self, rank, pieces)
-                if modified: break
-
-
-def _update_ranks_from_clean(self, rank, pieces):
-    modified = False
-    for piece in pieces:
-        if len(self._possible_ranks_per_piece[piece]) != 1:
-            for piece_probable_rank in self._possible_ranks_per_piece[piece]:
-                if piece_probable_rank == rank: continue
-                self._possible_pieces_per_rank[piece_probable_rank].discard(piece)
-            self._possible_ranks_per_piece[piece] = {rank}
-            modified = True
-    return modified
-
-
-def _update_pieces_from_clean(self, rank):
-    sure_pieces = set()
-    modified = False
-    for piece in self._possible_pieces_per_rank[rank]:
-        if len(self._possible_ranks_per_piece[piece]) == 1:
-            sure_pieces.add(piece)
-    if len(sure_pieces) == player_pieces[rank]:
-        if len(self._possible_pieces_per_rank[rank]) != player_pieces[rank]:
-            for piece in self._possible_pieces_per_rank[rank]:
-                if piece in sure_pieces: continue
-                self._possible_ranks_per_piece[piece].discard(rank)
-            self._possible_pieces_per_rank[rank] = sure_pieces
-            modified = True
-    return modified
+        duel_mask = BEATS_MASK if enemy_piece is eliminated_pieces[0] else BEATEN_BY_MASK
+        self._beliefs.exclude(enemy_piece.id - self._enemy_base,
+                              duel_mask[own_piece.rank.value] | 1 << own_piece.rank.value | FLAG_BIT)
+    self._beliefs.commit()
+
+
+def _sample_board_configuration(own_pieces_board, enemy_pieces, sampler, enemy, rng):
+    board_manager = own_pieces_board.copy()
+    ranks = sampler.sample(rng)
+    for index, piece_id in enemy_pieces:
+        board_manager.place(index, enemy << compact.PLAYER_SHIFT | ranks[piece_id])
+    return board_manager
+
+
+@lru_cache(maxsize=8)
+def _get_sampler(masks):
+    return DeterminizationSampler(masks)
+
+
+def _within_budget(simulations, playouts, deadline):
+    return (playouts is None or simulations < playouts) and (deadline is None or time.time() < deadline)
+
+
+# runs in worker processes too, so it only takes picklable arguments and its own RNG seed
+def _monte_carlo_playouts(own_pieces_board, enemy_pieces, sampler, player, moves, playouts, seed=None,
+                          deadline=None, policy=ROLLOUT_POLICIES['random'], cutoff=None):
+    rng = Random(seed) if seed is not None else random
+    enemy = 1 if player == 2 else 2
+    winning_moves = defaultdict(int)
+    simulations = 0
+    while _within_budget(simulations, playouts, deadline):
+        simulations += 1
+        beginning_move = moves[rng.randint(0, len(moves) - 1)]
+        board_manager = _sample_board_configuration(own_pieces_board, enemy_pieces, sampler, enemy, rng)
+        board_manager.move(beginning_move)
+        if _playout(board_manager, enemy, rng, policy, cutoff) == player:
+            winning_moves[beginning_move] += 1
+    return dict(winning_moves), simulations
+
+
+# plays until a flag falls, or until cutoff stops the playout and the static evaluation decides it
+def _playout(board_manager, current_turn, rng, policy=ROLLOUT_POLICIES['random'], cutoff=None):
+    board_manager.stop_hashing()
+    squares = board_manager.squares
+    # without a ply cap plies_left only goes further below zero
+    plies_left = cutoff.max_plies if cutoff is not None and cutoff.max_plies is not None else -1
+    seen = set() if cutoff is not None and cutoff.repetition else None
+    while not board_manager.get_victor():
+        if not plies_left:
+            return cutoff_victor(squares)
+        plies_left -= 1
+        if seen is not None:
+            position = bytes(squares), current_turn
+            if position in seen:
+                return cutoff_victor(squares)
+            seen.add(position)
+        valid_moves = compact.generate_valid_moves(squares, current_turn, board_manager.occupied[current_turn])
+        if not valid_moves:
+            break
+        board_manager.move_squares(*policy.choose(squares, current_turn, valid_moves, rng))
+        current_turn = 2 if current_turn == 1 else 1
+    return board_manager.get_victor()
+
+
+# masks[i] are the candidate ranks of the enemy piece with the i-th enemy id, as kept by Beliefs
+def _determinization_inputs(pov, player, masks):
+    own_pieces_board = CompactBoardManager.from_board(
+        [[x if x and x.player == player else None for x in row] for row in pov], view=player)
+    enemy_base = first_piece_id(1 if player == 2 else 2)
+    enemy_pieces = [(compact.square_index((i, j)), square.id - enemy_base)
+                    for i, row in enumerate(pov) for j, square in enumerate(row)
+                    if square and square.player != player]
+    sampler = _get_sampler(tuple(masks))
+    return own_pieces_board, enemy_pieces, sampler
+
+
+# None if no challenge took place, otherwise 1 if the mover won, 0 on a draw and -1 if the mover lost
+def _challenge_outcome(eliminated_players, mover):
+    if not eliminated_players:
+        return None
+    if len(eliminated_players) == 2:
+        return 0
+    return -1 if eliminated_players[0] == mover else 1
 
 
-class AISmart(AI):
+# search values stay strictly between a loss and a win
+_WIN = 10000
+_EXACT, _LOWER, _UPPER = range(3)
+
+
+class _SearchTimeout(Exception):
+    pass
+
+
+# rank value of an enemy piece averaged over its candidate ranks
+@lru_cache(maxsize=None)
+def _expected_value(mask):
+    return sum(COUNTS[r] * r for r in range(len(COUNTS)) if mask >> r & 1) / MASK_WEIGHTS[mask]
+
+
+class _TreeNode:
     def __init__(self, player):
-        super().__init__(player)
-        self._possible_ranks_per_piece = {}
-        self._possible_pieces_per_rank = {}
-        for rank in Rank:
-            self._possible_pieces_per_rank[rank] = set()
+        self.player = player
+        self.children = {}
+        self.visits = defaultdict(int)
+        self.wins = defaultdict(int)
+        self.available = defaultdict(int)
+
 
+class AISmart(AI):
+    batch_size = 1000
+    # depth of the expectiminimax search when there is no time limit
+    max_depth = 3
+
+    # playouts caps the number of simulations and time_limit the seconds spent per move, whichever runs out first.
+    # rollout names the policy in ROLLOUT_POLICIES that plays out the monte_carlo and tree searches. Their playouts
+    # stop after playout_plies moves and, with repetition_cutoff, on a repeated position, and are then decided by
+    # a static evaluation. executor is a process pool shared with other AIs that monte_carlo spreads its playouts
+    # over in workers chunks; it is left running by close. The batch search can instead hand its playouts to
+    # scheduler, a scheduler.MoveScheduler that plays them in one batch with those of other AIs.
+    def __init__(self, player, workers=1, search='monte_carlo', playouts=100, time_limit=None, rollout='random',
+                 playout_plies=None, repetition_cutoff=False, executor=None, scheduler=None):
+        assert search in ('monte_carlo', 'tree', 'batch', 'expectiminimax')
+        assert playouts is not None or time_limit is not None
+        assert scheduler is None or search == 'batch'
+        super().__init__(player)
+        self.scheduler = scheduler
+        self._workers = workers
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._search = search
+        self._rollout = ROLLOUT_POLICIES[rollout]
+        self._cutoff = Cutoff(playout_plies, repetition_cutoff) \
+            if playout_plies is not None or repetition_cutoff else None
+        self._tree = AISmart.TreeSearch(player, policy=self._rollout, cutoff=self._cutoff) \
+            if search == 'tree' else None
+        self._table = zobrist.TranspositionTable() if search == 'expectiminimax' else None
+        self._playouts = playouts
+        self._time_limit = time_limit
+        self.simulations = 0
+        # enemy pieces and their beliefs are indexed by piece id minus _enemy_base
+        self._enemy_base = first_piece_id(1 if player == 2 else 2)
+        self._enemy_pieces = []
+        self._beliefs = Beliefs(0)
+
+    # formations come from the opening book built offline by formation.py
     def get_init_form(self):
-        return generate_random_init_form()
+        return book.sample_formation() or generate_random_init_form()
 
     def board_event(self, event):
         assert self._pov
         if not event: return
-        _update_possibilities(self, event)
+        _update_occupied(self._occupied, self._pov, self._player, event[0])
+        _update_beliefs(self, event)
+        if self._tree:
+            self._tree.advance(event)
+
+    def close(self):
+        if self._executor is not None and self._owns_executor:
+            self._executor.shutdown(cancel_futures=True)
+        self._executor = None
 
     def enemy_set_pieces(self):
         assert self._pov
+        self._enemy_pieces = [None] * PIECES_PER_PLAYER
         for row in self._pov[5:8]:
             for square in row:
                 if square:
-                    self._possible_ranks_per_piece[square] = set()
-                    for rank in Rank:
-                        self._possible_pieces_per_rank[rank].add(square)
-                        self._possible_ranks_per_piece[square].add(rank)
+                    self._enemy_pieces[square.id - self._enemy_base] = square
+        self._beliefs = Beliefs(PIECES_PER_PLAYER)
 
     def get_move(self):
         assert self._pov
-        monte_carlo = AISmart.MonteCarlo(self._pov, self._player, self._possible_ranks_per_piece)
+        deadline = time.time() + self._time_limit if self._time_limit is not None else None
+        if self.scheduler is not None:
+            return self.submit_move().result()
+        # the pov may be player 2's rotated view of the game's board, whose reads are slower than a list's, so the
+        # searches read a copy taken once per turn
+        pov = [row[:] for row in self._pov]
+        if self._tree:
+            self.simulations = self._tree.search(pov, self._beliefs.ranks, self._playouts, deadline)
+            return self._tree.get_move() or _get_random_move(pov, self._player, self._occupied)
+        if self._search == 'batch':
+            return self._get_batch_move(pov, deadline)
+        if self._search == 'expectiminimax':
+            expectiminimax = AISmart.Expectiminimax(pov, self._player, self._beliefs, deadline,
+                                                    self.max_depth if deadline is None else None, self._table)
+            self.simulations = expectiminimax.nodes
+            return expectiminimax.get_move() or _get_random_move(pov, self._player, self._occupied)
+        if self._workers > 1 and self._executor is None:
+            self._executor = ProcessPoolExecutor(self._workers)
+        monte_carlo = AISmart.MonteCarlo(pov, self._player, self._beliefs.ranks,
+                                         self._playouts, self._executor, self._workers, deadline, self._rollout,
+                                         self._cutoff, self._occupied)
+        self.simulations = monte_carlo.simulations
         return monte_carlo.get_move()
-        # pov_c = [[x for x in row] for row in self._pov]
-        # ranks_per_piece_c = _duel_dict_copy(self._possible_ranks_per_piece)
-        # pieces_per_rank_c = _duel_dict_copy(self._possible_pieces_per_rank)
-        # initial_time = time.time_ns()
-        # timeout_time = initial_time + 5 * 1_000_000_000
-        # mini_max = AISmart.MiniMax(self._player, pov_c, ranks_per_piece_c, pieces_per_rank_c, initial_time,
-        #                              timeout_time)
-        # return mini_max.get_move()
+
+    # returns a Future of the move, which the scheduler searches without the AI's state, so the AI can take board
+    # events before it is done
+    def submit_move(self):
+        assert self._pov
+        deadline = time.time() + self._time_limit if self._time_limit is not None else None
+        return self.scheduler.submit(self._pov, self._player, self._beliefs.ranks, self._playouts, deadline,
+                                     self._occupied)
+
+    def _get_batch_move(self, pov, deadline):
+        import batch  # numpy is only needed for this search
+        own_pieces_board, enemy_pieces, sampler = _determinization_inputs(pov, self._player, self._beliefs.ranks)
+        enemy = 1 if self._player == 2 else 2
+        moves = _generate_valid_moves(pov, self._player, self._occupied)
+        self.simulations = 0
+        if not moves:
+            return None
+        rng = batch.np.random.default_rng(getrandbits(64))
+        winning_moves = defaultdict(int)
+        while _within_budget(self.simulations, self._playouts, deadline):
+            size = self._playouts - self.simulations if self._playouts is not None else self.batch_size
+            board_managers = []
+            root_moves = []
+            # drawing the boards takes a while too, so it stops halfway to the deadline to leave time to play them
+            draw_until = None if deadline is None else time.time() + (deadline - time.time()) / 2
+            for _ in range(size):
+                if draw_until is not None and time.time() >= draw_until:
+                    break
+                root_moves.append(moves[randint(0, len(moves) - 1)])
+                board_managers.append(_sample_board_configuration(own_pieces_board, enemy_pieces, sampler, enemy,
+                                                                  random))
+                board_managers[-1].move(root_moves[-1])
+            victor_counts, finished = batch.batch_playouts(board_managers, root_moves, enemy, rng,
+                                                           deadline=deadline)
+            for move, counts in victor_counts.items():
+                winning_moves[move] += counts[self._player]
+            self.simulations += finished
+        if not winning_moves:
+            return _get_random_move(pov, self._player, self._occupied)
+        return max(winning_moves.items(), key=lambda x: x[1])[0]
 
     class MonteCarlo:
-        def __init__(self, pov, player, possible_ranks_per_piece):
-            self._pov = pov
-            self._player = player
-            self._possible_ranks_per_piece = possible_ranks_per_piece
-            moves = _generate_valid_moves(pov, player)
-            winning_moves = defaultdict(int)
-            for _ in range(100):
-                beginning_move = moves[randint(0, len(moves) - 1)]
-                board = self._generate_valid_board_configuration()
-                board_manager = BoardManager(board)
-                board_manager.move(beginning_move)
-                current_turn = 1 if player == 2 else 2
-                while not board_manager.get_victor():
-                    move = _get_random_move(board, current_turn)
-                    board_manager.move(move)
-                    current_turn = 2 if current_turn == 1 else 1
-                if board_manager.get_victor() == player:
-                    winning_moves[beginning_move] += 1
+        def __init__(self, pov, player, masks, playouts=100, executor=None, workers=1,
+                     deadline=None, policy=ROLLOUT_POLICIES['random'], cutoff=None, occupied=None):
+            own_pieces_board, enemy_pieces, sampler = _determinization_inputs(pov, player, masks)
+            moves = _generate_valid_moves(pov, player, occupied)
+            if not moves:
+                winning_moves, self.simulations = {}, 0
+            elif executor is None or workers <= 1:
+                winning_moves, self.simulations = _monte_carlo_playouts(
+                    own_pieces_board, enemy_pieces, sampler, player, moves, playouts, deadline=deadline,
+                    policy=policy, cutoff=cutoff)
+            else:
+                chunks = [None] * workers if playouts is None else \
+                    [playouts // workers + (1 if i < playouts % workers else 0) for i in range(workers)]
+                futures = [executor.submit(_monte_carlo_playouts, own_pieces_board, enemy_pieces, sampler, player,
+                                           moves, chunk, getrandbits(64), deadline, policy, cutoff)
+                           for chunk in chunks if chunk != 0]
+                winning_moves = defaultdict(int)
+                self.simulations = 0
+                for future in futures:
+                    worker_winning_moves, worker_simulations = future.result()
+                    self.simulations += worker_simulations
+                    for move, wins in worker_winning_moves.items():
+                        winning_moves[move] += wins
             if len(winning_moves) == 0:
-                self._best_move = _get_random_move(pov, player)
+                self._best_move = _get_random_move(pov, player, occupied)
             else:
                 self._best_move = max(winning_moves.items(), key=lambda x: x[1])[0]
 
-        def _generate_valid_board_configuration(self):
-            board_configuration = [[None] * 9 for _ in range(8)]
-            enemy_pieces = []
-            for i, row in enumerate(self._pov):
-                for j, square in enumerate(row):
-                    if square:
-                        if square.player == self._player:
-                            board_configuration[i][j] = square
-                        else:
-                            enemy_pieces.append(((i,j), self._possible_ranks_per_piece[square].copy()))
-            enemy_pieces.sort(key=lambda x : len(x[1]))
-            enemy_pieces_count = defaultdict(int)
-            for i in range(len(enemy_pieces)):
-                if i == len(enemy_pieces) - 1 and enemy_pieces_count[Rank.FLAG] == 0:
-                    rank = Rank.FLAG
+        def get_move(self):
+            return self._best_move
+
+    class TreeSearch:
+        exploration = 0.7
+
+        def __init__(self, player, table_bits=16, policy=ROLLOUT_POLICIES['random'], cutoff=None):
+            self._player = player
+            self._policy = policy
+            self._cutoff = cutoff
+            self._root = None
+            # nodes by the hash of the position as the searching player sees it, so that move orders reaching the
+            # same position share statistics. Node statistics are per orientation, so mirrors are not merged.
+            self.table = zobrist.TranspositionTable(table_bits)
+
+        def search(self, pov, masks, iterations=100, deadline=None):
+            if self._root is None:
+                self._root = _TreeNode(self._player)
+            assert self._root.player == self._player
+            self.table.new_search()
+            own_pieces_board, enemy_pieces, sampler = _determinization_inputs(pov, self._player, masks)
+            enemy = 1 if self._player == 2 else 2
+            simulations = 0
+            while _within_budget(simulations, iterations, deadline):
+                board_manager = _sample_board_configuration(own_pieces_board, enemy_pieces, sampler, enemy, random)
+                self._iterate(board_manager)
+                simulations += 1
+            return simulations
+
+        def _iterate(self, board_manager):
+            node = self._root
+            current_turn = node.player
+            path = []
+            on_path = set()
+            while node and node not in on_path and not board_manager.get_victor():
+                on_path.add(node)
+                valid_moves = compact.generate_valid_moves(board_manager.squares, current_turn,
+                                                           board_manager.occupied[current_turn])
+                if not valid_moves:
+                    break
+                for move in valid_moves:
+                    node.available[move] += 1
+                untried = [move for move in valid_moves if not node.visits[move]]
+                if untried:
+                    move = untried[randint(0, len(untried) - 1)]
+                else:
+                    move = max(valid_moves, key=lambda m: node.wins[m] / node.visits[m] + self.exploration *
+                               math.sqrt(math.log(node.available[m]) / node.visits[m]))
+                eliminated_pieces = board_manager.move_squares(*move)
+                path.append((node, move))
+                current_turn = 2 if current_turn == 1 else 1
+                key = move, _challenge_outcome(eliminated_pieces and [x >> compact.PLAYER_SHIFT for x in
+                                                                      eliminated_pieces], node.player)
+                if key not in node.children:
+                    position = board_manager.position_hash(current_turn)[0]
+                    child = self._transposition(position)
+                    if child is None:
+                        child = _TreeNode(current_turn)
+                        self.table.store(position, value=child)
+                        node.children[key] = child
+                        node = None
+                    else:
+                        node.children[key] = node = child
                 else:
-                    rank = list(enemy_pieces[i][1])[randint(0, len(enemy_pieces[i][1]) - 1)]
-                enemy_pieces_count[rank] += 1
-                board_configuration[enemy_pieces[i][0][0]][enemy_pieces[i][0][1]] = Piece(rank, 1 if self._player == 2 else 2)
-                if enemy_pieces_count[rank] == player_pieces[rank]:
-                    for j in range(i + 1, len(enemy_pieces)):
-                        enemy_pieces[j][1].discard(rank)
-                        if j > i + 1 and len(enemy_pieces[j-1][1]) > len(enemy_pieces[j][1]):
-                            enemy_pieces[j-1], enemy_pieces[j] = enemy_pieces[j], enemy_pieces[j-1]
+                    node = node.children[key]
+            victor = _playout(board_manager, current_turn, random, self._policy, self._cutoff)
+            for node, move in path:
+                node.visits[move] += 1
+                if victor == node.player:
+                    node.wins[move] += 1
 
-            return board_configuration
+        def _transposition(self, position):
+            entry, _ = self.table.probe(position)
+            return entry.value if entry else None
 
         def get_move(self):
-            return self._best_move
-
-    class MiniMax:
-        # non functional (buggy) xD
-        def __init__(self, player, pov, can_be, pieces_for_each_rank, init_time, timeout_time):
-            assert player == 2
+            if self._root is None or not self._root.visits:
+                return None
+            move = max(self._root.visits, key=lambda m: (self._root.visits[m], self._root.wins[m]))
+            return compact.square_pos(move[0]), compact.square_pos(move[1])
+
+        # descends to the subtree of the move that was actually played, or drops the tree if it was never explored
+        def advance(self, event):
+            if self._root is None:
+                return
+            move, eliminated_pieces = event
+            move = compact.square_index(move[0]), compact.square_index(move[1])
+            outcome = _challenge_outcome(eliminated_pieces and [x.player for x in eliminated_pieces],
+                                         self._root.player)
+            self._root = self._root.children.get((move, outcome))
+
+    class Expectiminimax:
+        def __init__(self, pov, player, beliefs, deadline=None, max_depth=None, table=None):
+            assert deadline is not None or max_depth is not None
+            self._pov = [row[:] for row in pov]
+            # the squares of both players' pieces, kept up to date by _make and _unmake
+            self._occupied = {p: _occupied_squares(self._pov, p) for p in (1, 2)}
             self._player = player
-            self._pov = pov
-            self._possible_ranks_per_piece = can_be
-            self._possible_pieces_per_rank = pieces_for_each_rank
-            self._init_time = init_time
-            self._timeout_time = timeout_time
+            self._enemy = 1 if player == 2 else 2
+            self._beliefs = beliefs.copy()
+            self._enemy_base = first_piece_id(self._enemy)
+            self._deadline = deadline
+            self._table = table if table is not None else zobrist.TranspositionTable()
+            self._table.new_search()
+            self._keys = zobrist.KEYS[player]
+            self._mirror_keys = zobrist.MIRROR_KEYS[player]
+            squares = [self._code(square) for row in self._pov for square in row]
+            self._hash = zobrist.hash_squares(squares, self._keys)
+            self._mirror_hash = zobrist.hash_squares(squares, self._mirror_keys)
+            self.nodes = 0
+            self.depth = 0
             self._best_move = None
-            self._initial_depth = 3
-            self._search(self._initial_depth, -math.inf, math.inf, player)
-
-        # -1 if mover dies, 0 if draw, 1 if mover lives
-        def _get_possible_outcomes(self, move):
-            if not self._pov[move[1][0]][move[1][1]]:
-                return (1, 1),
-            own_piece = self._pov[move[0][0]][move[0][1]] if self._pov[move[0][0]][move[0][1]].player == self._player \
-                else self._pov[move[1][0]][move[1][1]]
-            enemy_piece = self._pov[move[1][0]][move[1][1]] if self._pov[move[1][0]][move[1][1]].player != self._player \
-                else self._pov[move[0][0]][move[0][1]]
-            own_piece_is_mover = own_piece is self._pov[move[0][0]][move[0][1]]
-            prob_denom = sum([player_pieces[x] for x in self._possible_ranks_per_piece[enemy_piece]])
-            if own_piece.rank == Rank.FLAG:
-                win_prob_num = 0 if not own_piece_is_mover or Rank.FLAG not in self._possible_ranks_per_piece[
-                    enemy_piece] else 1
-                draw_prob_num = 0
-                lose_prob_num = prob_denom if not own_piece_is_mover or \
-                                              Rank.FLAG not in self._possible_ranks_per_piece[
-                                                  enemy_piece] else prob_denom - 1
-            else:
-                win_prob_num = sum([player_pieces[x] for x in beats[own_piece.rank] if
-                                    x in self._possible_ranks_per_piece[enemy_piece]])
-                draw_prob_num = player_pieces[own_piece.rank] if own_piece.rank in self._possible_ranks_per_piece[
-                    enemy_piece] else 0
-                lose_prob_num = sum(
-                    [player_pieces[x] for x in beaten_by[own_piece.rank] if
-                     x in self._possible_ranks_per_piece[enemy_piece]])
-            assert prob_denom == win_prob_num + draw_prob_num + lose_prob_num
-            if own_piece_is_mover:
-                return (
-                    (-1, lose_prob_num / prob_denom),
-                    (0, draw_prob_num / prob_denom),
-                    (1, win_prob_num / prob_denom),
-                )
-            return (
-                (-1, win_prob_num / prob_denom),
-                (0, draw_prob_num / prob_denom),
-                (1, lose_prob_num / prob_denom),
-            )
-
-        def _try_outcome(self, move, outcome):
-            if not self._pov[move[1][0]][move[1][1]]:
-                self._pov[move[1][0]][move[1][1]] = self._pov[move[0][0]][move[0][1]]
-                self._pov[move[0][0]][move[0][1]] = None
-                return
-            if outcome == -1:
-                eliminated_pieces = self._pov[move[0][0]][move[0][1]],
-                self._pov[move[0][0]][move[0][1]] = None
-            elif outcome == 0:
-                eliminated_pieces = self._pov[move[0][0]][move[0][1]], self._pov[move[1][0]][move[1][1]]
-                self._pov[move[0][0]][move[0][1]] = None
-                self._pov[move[1][0]][move[1][1]] = None
-            else:
-                eliminated_pieces = self._pov[move[1][0]][move[1][1]],
-                self._pov[move[1][0]][move[1][1]] = self._pov[move[0][0]][move[0][1]]
-                self._pov[move[0][0]][move[0][1]] = None
-            _update_possibilities(self, (move, eliminated_pieces))
-
-        def _evaluate(self):
+            self._iteration_move = None
+            # iterative deepening, keeping the move of the deepest search that finished
+            try:
+                while max_depth is None or self.depth < max_depth:
+                    value = self._negamax(self.depth + 1, -_WIN, _WIN, player, 0)
+                    self.depth += 1
+                    self._best_move = self._iteration_move
+                    if abs(value) >= _WIN:
+                        break
+            except _SearchTimeout:
+                pass
+
+        def _code(self, square):
+            if not square:
+                return 0
+            if square.player != self._player:
+                return square.player << compact.PLAYER_SHIFT | zobrist.HIDDEN
+            return compact.encode(square.rank, square.player)
+
+        # (probability, outcome, enemy ranks, victor) for every way the move can go, where outcome is -1 if the
+        # mover dies, 0 on a draw and 1 if the mover lives. enemy ranks restricts the enemy piece involved (None
+        # leaves it alone) and victor is set if the outcome ends the game.
+        def _get_possible_outcomes(self, move, player):
+            mover = self._pov[move[0][0]][move[0][1]]
+            target = self._pov[move[1][0]][move[1][1]]
+            if not target:
+                return self._get_advance_outcomes(move, mover)
+            own_piece, enemy_piece = (mover, target) if player == self._player else (target, mover)
+            enemy_id = enemy_piece.id - self._enemy_base
+            candidates = self._beliefs.ranks[enemy_id]
+            # outcomes are from the mover's side
+            masks = DUEL_MASKS[own_piece.rank.value] if player == self._player else \
+                CHALLENGER_MASKS[own_piece.rank.value]
+            outcomes = []
+            for outcome in (LOSS, DRAW, WIN):
+                mask = candidates & masks[outcome]
+                own_piece_dies = outcome == DRAW or (outcome == WIN) != (player == self._player)
+                enemy_piece_dies = outcome == DRAW or (outcome == WIN) == (player == self._player)
+                if own_piece_dies and own_piece.rank == Rank.FLAG:
+                    outcomes.append((mask, outcome, mask, self._enemy))
+                elif enemy_piece_dies:
+                    outcomes.append((mask & FLAG_BIT, outcome, mask & FLAG_BIT, self._player))
+                    outcomes.append((mask & ~FLAG_BIT, outcome, mask & ~FLAG_BIT, 0))
+                else:
+                    outcomes.append((mask, outcome, mask, 0))
+            return self._weigh(enemy_id, outcomes)
+
+        # a flag reaching the far row without an enemy piece beside it wins. Whether it wins later when an enemy
+        # piece is beside it is left to deeper searches.
+        def _get_advance_outcomes(self, move, mover):
+            row, col = move[1]
+            far_row = 7 if mover.player == self._player else 0
+            if row != far_row or any(0 <= col + d < 9 and self._pov[row][col + d] and
+                                     self._pov[row][col + d].player != mover.player for d in (-1, 1)):
+                return (1, 1, None, 0),
+            if mover.player == self._player:
+                return (1, 1, None, self._player if mover.rank == Rank.FLAG else 0),
+            enemy_id = mover.id - self._enemy_base
+            candidates = self._beliefs.ranks[enemy_id]
+            return self._weigh(enemy_id, [(candidates & FLAG_BIT, 1, FLAG_BIT, self._enemy),
+                                          (candidates & ~FLAG_BIT, 1, candidates & ~FLAG_BIT, 0)])
+
+        # weighs every outcome by the number of pieces of its enemy ranks and drops those the beliefs rule out
+        def _weigh(self, enemy_id, outcomes):
+            weighted = []
+            for weight_mask, outcome, mask, victor in outcomes:
+                weight = MASK_WEIGHTS[weight_mask]
+                if not weight:
+                    continue
+                if not victor:
+                    mark = self._beliefs.mark()
+                    consistent = self._beliefs.restrict(enemy_id, mask)
+                    self._beliefs.undo(mark)
+                    if not consistent:
+                        continue
+                weighted.append((weight, outcome, mask, victor))
+            total = sum(x[0] for x in weighted)
+            return [(weight / total, outcome, mask, victor) for weight, outcome, mask, victor in weighted]
+
+        def _make(self, move, outcome):
+            (r1, c1), (r2, c2) = move
+            mover = self._pov[r1][c1]
+            target = self._pov[r2][c2]
+            undo = move, mover, target, self._hash, self._mirror_hash
+            result = mover if outcome == 1 else target if outcome == -1 else None
+            self._pov[r1][c1] = None
+            self._pov[r2][c2] = result
+            self._occupied[mover.player].discard(move[0])
+            if target is not None and result is not target:
+                self._occupied[target.player].discard(move[1])
+            if result is mover:
+                self._occupied[mover.player].add(move[1])
+            src = r1 * 9 + c1
+            dst = r2 * 9 + c2
+            self._hash ^= self._keys[src][self._code(mover)] ^ self._keys[dst][self._code(target)] ^ \
+                self._keys[dst][self._code(result)]
+            self._mirror_hash ^= self._mirror_keys[src][self._code(mover)] ^ \
+                self._mirror_keys[dst][self._code(target)] ^ self._mirror_keys[dst][self._code(result)]
+            return undo
+
+        def _unmake(self, undo):
+            move, mover, target, self._hash, self._mirror_hash = undo
+            (r1, c1), (r2, c2) = move
+            self._pov[r1][c1] = mover
+            self._pov[r2][c2] = target
+            self._occupied[mover.player].discard(move[1])
+            self._occupied[mover.player].add(move[0])
+            if target is not None:
+                self._occupied[target.player].add(move[1])
+
+        # own material against the expected material of the enemy pieces, from the point of view of player
+        def _evaluate(self, player):
             res = 0
-            own_flag_coord = None
-            enemy_flag = False
-            for i, row in enumerate(self._pov):
-                for j, square in enumerate(row):
+            for row in self._pov:
+                for square in row:
                     if square:
                         if square.player == self._player:
-                            if square.rank == Rank.FLAG:
-                                own_flag_coord = (i,j)
-                            else:
-                                res += square.rank.value
+                            res += square.rank.value
                         else:
-                            if Rank.FLAG in self._possible_ranks_per_piece[square]:
-                                enemy_flag = True
-                            else:
-                                res -= 6
-            if own_flag_coord is None:
-                return -math.inf
-            if not enemy_flag:
-                return math.inf
-            res += 10 * own_flag_coord[1]
-            return res
-
-        def _get_current_state_copy(self):
-            cb_copy = _duel_dict_copy(self._possible_ranks_per_piece)
-            pfer_copy = _duel_dict_copy(self._possible_pieces_per_rank)
-            pov_copy = [[x for x in row] for row in self._pov]
-            return [cb_copy, pfer_copy, pov_copy]
-
-        def _revert_state(self, state):
-            self._possible_ranks_per_piece = state[0]
-            self._possible_pieces_per_rank = state[1]
-            self._pov = state[2]
-
-        def _search(self, depth, alpha, beta, player_to_move):
+                            res -= _expected_value(self._beliefs.ranks[square.id - self._enemy_base])
+            return res if player == self._player else -res
+
+        def _ordered_moves(self, player, first):
+            moves = _generate_valid_moves(self._pov, player, self._occupied[player])
+            # challenges first, then the best move of an earlier search on top
+            moves.sort(key=lambda m: self._pov[m[1][0]][m[1][1]] is None)
+            if first in moves:
+                moves.remove(first)
+                moves.insert(0, first)
+            return moves
+
+        def _negamax(self, depth, alpha, beta, player, ply):
+            self.nodes += 1
+            if self._deadline is not None and time.time() > self._deadline:
+                raise _SearchTimeout()
             if depth == 0:
-                return self._evaluate()
-            valid_moves = _generate_valid_moves(self._pov, player_to_move)
-            for move in valid_moves:
-                for outcome, probability in self._get_possible_outcomes(move):
-                    if not probability: continue
-                    current_state = self._get_current_state_copy()
-                    self._try_outcome(move, outcome)
-                    valid = True
-                    for piece, ranks in self._possible_ranks_per_piece.items():
-                        # invalid state since a piece has no probable rank
-                        if len(ranks) == 0:
-                            valid = False
-                            break
-                    if not valid:
-                        self._revert_state(current_state)
-                        continue
-                    evaluation = -(probability * self._search(depth - 1, -beta/probability, -alpha/probability, 1 if player_to_move == 2 else 2))
-                    self._revert_state(current_state)
-                    if evaluation >= beta:
+                return self._evaluate(player)
+            turn = zobrist.TURN_KEY if player == 2 else 0
+            key = self._hash ^ turn, self._mirror_hash ^ turn
+            entry, mirrored = self._table.probe(*key)
+            first = None
+            if entry:
+                value, bound = entry.value
+                if ply and entry.depth >= depth and (bound == _EXACT or (bound == _LOWER and value >= beta) or
+                                                     (bound == _UPPER and value <= alpha)):
+                    return value
+                if entry.best_move:
+                    first = zobrist.mirror_move(entry.best_move) if mirrored else entry.best_move
+                    first = compact.square_pos(first[0]), compact.square_pos(first[1])
+            moves = self._ordered_moves(player, first)
+            if not moves:
+                return 0
+            original_alpha = alpha
+            best_value = -math.inf
+            best_move = None
+            for move in moves:
+                value = self._chance(move, depth, alpha, beta, player, ply)
+                if value > best_value:
+                    best_value = value
+                    best_move = move
+                    if not ply:
+                        self._iteration_move = move
+                alpha = max(alpha, value)
+                if alpha >= beta:
+                    break
+            bound = _UPPER if best_value <= original_alpha else _LOWER if best_value >= beta else _EXACT
+            self._table.store(*key, value=(best_value, bound), best_move=(compact.square_index(best_move[0]),
+                              compact.square_index(best_move[1])), depth=depth)
+            return best_value
+
+        # expected value of the move over its challenge outcomes. The window of every outcome is narrowed so
+        # that the search stops as soon as the expectation is sure to fall outside alpha-beta (Star1 pruning).
+        def _chance(self, move, depth, alpha, beta, player, ply):
+            total = 0
+            remaining = 1
+            for probability, outcome, mask, victor in self._get_possible_outcomes(move, player):
+                remaining -= probability
+                if victor:
+                    value = _WIN if victor == player else -_WIN
+                else:
+                    child_alpha = max((alpha - total - _WIN * remaining) / probability, -_WIN)
+                    child_beta = min((beta - total + _WIN * remaining) / probability, _WIN)
+                    value = self._outcome_value(move, outcome, mask, depth, child_alpha, child_beta, player, ply)
+                    if value <= child_alpha:
+                        return alpha
+                    if value >= child_beta:
                         return beta
-                    if evaluation > alpha:
-                        alpha = evaluation
-                        if depth == self._initial_depth:
-                            self._best_move = move
-            return alpha
+                total += probability * value
+            return total
+
+        def _outcome_value(self, move, outcome, mask, depth, alpha, beta, player, ply):
+            mark = self._beliefs.mark()
+            if mask is not None:
+                enemy_piece = self._pov[move[1][0]][move[1][1]] if player == self._player else \
+                    self._pov[move[0][0]][move[0][1]]
+                self._beliefs.restrict(enemy_piece.id - self._enemy_base, mask)
+            undo = self._make(move, outcome)
+            value = -self._negamax(depth - 1, -beta, -alpha, 1 if player == 2 else 2, ply + 1)
+            self._unmake(undo)
+            self._beliefs.undo(mark)
+            return value
 
         def get_move(self):
             return self._best_move
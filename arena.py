@@ -0,0 +1,150 @@
+import argparse
+import json
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from statistics import mean
+
+from gog import GOG
+from ai import AIRandom, AISmart
+from record import GameRecord, RecordWriter
+
+ENGINES = {
+    'random': (AIRandom, {}),
+    'monte_carlo': (AISmart, {}),
+    'monte_carlo_heuristic': (AISmart, {'rollout': 'heuristic'}),
+    'monte_carlo_cutoff': (AISmart, {'playout_plies': 80, 'repetition_cutoff': True}),
+    'tree': (AISmart, {'search': 'tree'}),
+    'tree_heuristic': (AISmart, {'search': 'tree', 'rollout': 'heuristic'}),
+    'batch': (AISmart, {'search': 'batch'}),
+    'expectiminimax': (AISmart, {'search': 'expectiminimax'}),
+}
+
+
+# time_limit gives AISmart engines the same seconds per move instead of a number of playouts, and executor a process
+# pool shared by many AIs that their playouts are spread over in workers chunks. The batch engine hands its
+# playouts to scheduler, if given.
+def make_ai(engine, player, time_limit=None, executor=None, workers=1, scheduler=None):
+    cls, kwargs = ENGINES[engine]
+    if time_limit is not None and cls is AISmart:
+        kwargs = {**kwargs, 'playouts': None, 'time_limit': time_limit}
+    if executor is not None and cls is AISmart:
+        kwargs = {**kwargs, 'executor': executor, 'workers': workers}
+    if scheduler is not None and kwargs.get('search') == 'batch':
+        kwargs = {**kwargs, 'scheduler': scheduler}
+    return cls(player, **kwargs)
+
+
+# engines[0] plays as player 1 and engines[1] as player 2; a game cut off at max_plies is a draw
+def play_game(engines, seed, max_plies=1000, time_limit=None):
+    random.seed(seed)
+    gog = GOG()
+    ais = {1: make_ai(engines[0], 1, time_limit), 2: make_ai(engines[1], 2, time_limit)}
+    for player in [1, 2]:
+        ais[player].set_pov(gog.set_player_pieces(ais[player].get_init_form(), player))
+    for player in [1, 2]:
+        ais[player].enemy_set_pieces()
+    latencies = {1: [], 2: []}
+    plies = 0
+    while not gog.victor and plies < max_plies:
+        player = gog.current_turn
+        start = time.perf_counter()
+        move = ais[player].get_move()
+        latencies[player].append(time.perf_counter() - start)
+        if move is None:
+            break
+        event = gog.move(move[0], move[1], player)
+        assert event
+        ais[1].board_event((event[0][1], event[1]))
+        ais[2].board_event((event[0][2], event[1]))
+        plies += 1
+    for ai in ais.values():
+        if hasattr(ai, 'close'):
+            ai.close()
+    return {'engines': engines, 'victor': gog.victor, 'plies': plies, 'latencies': latencies,
+            'record': GameRecord.from_gog(gog)}
+
+
+def _play_game(args):
+    swapped, engines, seed, max_plies, time_limit = args
+    result = play_game(engines, seed, max_plies, time_limit)
+    result['seats'] = {1: 'two', 2: 'one'} if swapped else {1: 'one', 2: 'two'}
+    return result
+
+
+# record names a file that every game is written to in the record format
+def run(engine_one, engine_two, games, workers=1, max_plies=1000, seed=0, record=None, time_limit=None):
+    # seats alternate so that neither engine always moves first
+    jobs = [(i % 2 == 1, (engine_one, engine_two) if i % 2 == 0 else (engine_two, engine_one), seed + i, max_plies,
+             time_limit) for i in range(games)]
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(_play_game, jobs, chunksize=max(1, games // (workers * 4))))
+    else:
+        results = [_play_game(job) for job in jobs]
+    if record:
+        with open(record, 'wb') as f:
+            writer = RecordWriter(f)
+            for result in results:
+                writer.write(result['record'])
+    return summarize(results, {'one': engine_one, 'two': engine_two})
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def summarize(results, engines):
+    wins = {seat: 0 for seat in engines}
+    latencies = {seat: [] for seat in engines}
+    draws = 0
+    for result in results:
+        for player in [1, 2]:
+            latencies[result['seats'][player]] += result['latencies'][player]
+        if result['victor']:
+            wins[result['seats'][result['victor']]] += 1
+        else:
+            draws += 1
+    games = len(results)
+    report = {
+        'games': games,
+        'draws': draws,
+        'draw_rate': draws / games if games else None,
+        'average_plies': mean(r['plies'] for r in results) if games else None,
+        'engines': {},
+    }
+    for seat, engine in engines.items():
+        report['engines'][seat] = {
+            'engine': engine,
+            'wins': wins[seat],
+            'win_rate': wins[seat] / games if games else None,
+            'moves': len(latencies[seat]),
+            'latency_mean': mean(latencies[seat]) if latencies[seat] else None,
+            'latency_p50': _percentile(latencies[seat], 0.5),
+            'latency_p95': _percentile(latencies[seat], 0.95),
+            'latency_max': max(latencies[seat]) if latencies[seat] else None,
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless self-play between two AI engines.')
+    parser.add_argument('engine_one', choices=ENGINES)
+    parser.add_argument('engine_two', choices=ENGINES)
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--max-plies', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', help='also write every game to this file in the binary record format')
+    parser.add_argument('--time-limit', type=float,
+                        help='seconds per move for the searching engines, to compare strength at equal CPU time')
+    args = parser.parse_args()
+    print(json.dumps(run(args.engine_one, args.engine_two, args.games, args.workers, args.max_plies, args.seed,
+                         args.record, args.time_limit), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from rank import DUEL
+from compact import PLAYER_SHIFT, RANK_MASK, FLAG
+from topology import ROWS, COLS, SQUARES, DIRECTIONS
+
+# _duel[a, d] is 1 if a piece of rank value a eliminates a piece of rank value d, 0 if both die, -1 if a dies
+_duel = np.array(DUEL, dtype=np.int8)
+
+# every (square, direction) pair as a flat candidate move
+_src = np.repeat(np.arange(SQUARES), 4)
+_dst = np.empty(SQUARES * 4, dtype=np.int64)
+_valid = np.empty(SQUARES * 4, dtype=bool)
+for _i in range(SQUARES):
+    _r, _c = divmod(_i, COLS)
+    for _k, (_dr, _dc) in enumerate(DIRECTIONS):
+        _valid[_i * 4 + _k] = 0 <= _r + _dr < ROWS and 0 <= _c + _dc < COLS
+        _dst[_i * 4 + _k] = (_r + _dr) * COLS + _c + _dc if _valid[_i * 4 + _k] else _i
+
+
+class BatchSimulator:
+    def __init__(self, board, turn, winning=None):
+        self.board = board
+        self.turn = turn
+        self.winning = winning if winning is not None else np.zeros((len(board), 3), dtype=bool)
+        self.victor = np.zeros(len(board), dtype=np.int8)
+        self.finished = np.zeros(len(board), dtype=bool)
+        self.expired = np.zeros(len(board), dtype=bool)
+
+    @classmethod
+    def from_compact(cls, board_managers, turn):
+        board = np.frombuffer(b''.join(bytes(x.squares) for x in board_managers), dtype=np.int8) \
+            .reshape(len(board_managers), SQUARES).copy()
+        simulator = cls(board, np.full(len(board_managers), turn, dtype=np.int8),
+                        np.array([x._winning for x in board_managers], dtype=bool).reshape(-1, 3))
+        simulator.victor[:] = [x.get_victor() for x in board_managers]
+        simulator.finished[:] = simulator.victor != 0
+        return simulator
+
+    # picks a uniformly random legal move for every unfinished game; games with no legal move finish undecided
+    def sample_moves(self, rng):
+        games = np.flatnonzero(~self.finished)
+        owner = self.board[games] >> PLAYER_SHIFT
+        turn = self.turn[games][:, None]
+        legal = (owner[:, _src] == turn) & _valid & (owner[:, _dst] != turn)
+        keys = rng.random(legal.shape)
+        keys[~legal] = -1
+        choice = keys.argmax(axis=1)
+        stuck = ~legal[np.arange(len(games)), choice]
+        self.finished[games[stuck]] = True
+        return games[~stuck], _src[choice[~stuck]], _dst[choice[~stuck]]
+
+    def apply_moves(self, games, src, dst):
+        rows = np.arange(len(games))
+        board = self.board[games]
+        turn = self.turn[games]
+        other = 3 - turn
+        winning = self.winning[games]
+        mover = board[rows, src]
+        target = board[rows, dst]
+        mover_rank = mover & RANK_MASK
+        target_rank = target & RANK_MASK
+        empty = target == 0
+        outcome = np.where(empty, 1, _duel[mover_rank, target_rank])
+        board[rows, dst] = np.where(outcome == 1, mover, np.where(outcome == 0, 0, target))
+        board[rows, src] = 0
+        victor = np.where(~empty & (outcome == 1) & (target_rank == FLAG), turn, 0)
+        victor = np.where(~empty & (outcome == -1) & (mover_rank == FLAG), other, victor)
+        dst_row, dst_col = np.divmod(dst, COLS)
+        reached = empty & (mover_rank == FLAG) & (dst_row == np.where(turn == 1, ROWS - 1, 0))
+        left = np.where(dst_col > 0, board[rows, np.maximum(dst - 1, 0)] >> PLAYER_SHIFT, 0)
+        right = np.where(dst_col < COLS - 1, board[rows, np.minimum(dst + 1, SQUARES - 1)] >> PLAYER_SHIFT, 0)
+        guarded = (left == other) | (right == other)
+        victor = np.where(reached & ~guarded, turn, victor)
+        winning[rows[reached & guarded], turn[reached & guarded]] = True
+        victor = np.where((victor == 0) & winning[rows, other], other, victor)
+        self.board[games] = board
+        self.winning[games] = winning
+        self.victor[games] = victor
+        self.finished[games] |= victor != 0
+        self.turn[games] = other
+
+    def step(self, rng):
+        games, src, dst = self.sample_moves(rng)
+        if len(games):
+            self.apply_moves(games, src, dst)
+
+    # deadline is a time for every game or an array with one for each game. A game past its own deadline finishes
+    # undecided and is marked expired.
+    def run(self, rng, max_plies=None, deadline=None):
+        per_game = isinstance(deadline, np.ndarray)
+        plies = 0
+        while max_plies is None or plies < max_plies:
+            if per_game:
+                expired = ~self.finished & (deadline <= time.time())
+                self.expired |= expired
+                self.finished |= expired
+            if self.finished.all() or (not per_game and deadline is not None and time.time() >= deadline):
+                break
+            self.step(rng)
+            plies += 1
+        return self.victor
+
+
+# plays every determinized board after its root move and counts victors (0 for undecided) per root move
+def batch_playouts(board_managers, root_moves, turn, rng, max_plies=None, deadline=None):
+    simulator = BatchSimulator.from_compact(board_managers, turn)
+    victor = simulator.run(rng, max_plies, deadline)
+    victor_counts = defaultdict(lambda: [0, 0, 0])
+    for move, v in zip(root_moves, victor.tolist()):
+        victor_counts[move][v] += 1
+    return dict(victor_counts), int(simulator.finished.sum())
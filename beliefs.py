@@ -0,0 +1,131 @@
+from rank import Rank, beats, beaten_by
+from gog import player_pieces
+
+ALL_RANKS = (1 << len(Rank)) - 1
+COUNTS = [player_pieces[Rank(r)] for r in range(len(Rank))]
+FLAG_BIT = 1 << Rank.FLAG.value
+
+# BEATS_MASK[r] has a bit set for every rank that eliminates rank r when they meet
+BEATS_MASK = [sum(1 << x.value for x in beats[Rank(r)]) for r in range(len(Rank))]
+# BEATEN_BY_MASK[r] has a bit set for every rank that rank r eliminates
+BEATEN_BY_MASK = [sum(1 << x.value for x in beaten_by[Rank(r)]) for r in range(len(Rank))]
+
+# MASK_WEIGHTS[mask] is the number of pieces a player has of the ranks in mask
+MASK_WEIGHTS = [0] * (ALL_RANKS + 1)
+for _mask in range(1, ALL_RANKS + 1):
+    _low = _mask & -_mask
+    MASK_WEIGHTS[_mask] = MASK_WEIGHTS[_mask ^ _low] + COUNTS[_low.bit_length() - 1]
+
+
+def rank_mask(ranks):
+    mask = 0
+    for rank in ranks:
+        mask |= 1 << rank.value
+    return mask
+
+
+def mask_ranks(mask):
+    ranks = set()
+    while mask:
+        low = mask & -mask
+        ranks.add(Rank(low.bit_length() - 1))
+        mask ^= low
+    return ranks
+
+
+# candidate ranks of every enemy piece as a 15-bit mask and candidate pieces of every rank as a bit mask over
+# piece ids, kept consistent with each other and with the number of pieces of each rank
+class Beliefs:
+    def __init__(self, n_pieces):
+        self.ranks = [ALL_RANKS] * n_pieces
+        self.pieces = [(1 << n_pieces) - 1] * len(Rank)
+        # sure[r] has a bit for every piece whose only candidate is r
+        self.sure = [0] * len(Rank)
+        self.consistent = True
+        self._trail = []
+        self._ranks_worklist = []
+
+    def copy(self):
+        copy = Beliefs(0)
+        copy.ranks = self.ranks[:]
+        copy.pieces = self.pieces[:]
+        copy.sure = self.sure[:]
+        copy.consistent = self.consistent
+        return copy
+
+    def mark(self):
+        return len(self._trail), self.consistent
+
+    # drops the undo history once the current beliefs are final
+    def commit(self):
+        self._trail = []
+
+    def undo(self, mark):
+        length, self.consistent = mark
+        trail = self._trail
+        while len(trail) > length:
+            array, index, old = trail.pop()
+            array[index] = old
+
+    def rank_set(self, piece):
+        return mask_ranks(self.ranks[piece])
+
+    def piece_is(self, piece, rank):
+        return self.restrict(piece, 1 << rank.value)
+
+    def restrict(self, piece, mask):
+        return self.exclude(piece, ALL_RANKS & ~mask)
+
+    def exclude(self, piece, mask):
+        self._remove(piece, mask)
+        return self._propagate()
+
+    def _set(self, array, index, value):
+        self._trail.append((array, index, array[index]))
+        array[index] = value
+
+    def _remove(self, piece, mask):
+        ranks = self.ranks[piece]
+        removed = ranks & mask
+        if not removed:
+            return
+        ranks &= ~removed
+        self._set(self.ranks, piece, ranks)
+        bit = 1 << piece
+        while removed:
+            low = removed & -removed
+            r = low.bit_length() - 1
+            self._set(self.pieces, r, self.pieces[r] & ~bit)
+            self._ranks_worklist.append(r)
+            removed ^= low
+        if not ranks:
+            self.consistent = False
+        elif not ranks & (ranks - 1):
+            r = ranks.bit_length() - 1
+            self._set(self.sure, r, self.sure[r] | bit)
+            self._ranks_worklist.append(r)
+
+    def _propagate(self):
+        worklist = self._ranks_worklist
+        while worklist:
+            r = worklist.pop()
+            pieces = self.pieces[r]
+            sure = self.sure[r]
+            count = pieces.bit_count()
+            if count < COUNTS[r] or sure.bit_count() > COUNTS[r]:
+                self.consistent = False
+            elif sure.bit_count() == COUNTS[r] and pieces != sure:
+                # every piece of rank r is known, so no other piece can be r
+                others = pieces & ~sure
+                while others:
+                    low = others & -others
+                    self._remove(low.bit_length() - 1, 1 << r)
+                    others ^= low
+            elif count == COUNTS[r] and pieces != sure:
+                # exactly as many candidates as pieces of rank r, so all of them are r
+                others = pieces & ~sure
+                while others:
+                    low = others & -others
+                    self._remove(low.bit_length() - 1, ALL_RANKS & ~(1 << r))
+                    others ^= low
+        return self.consistent
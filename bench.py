@@ -0,0 +1,312 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from types import SimpleNamespace
+from statistics import median
+
+from gog import GOG, BoardManager, player_pieces
+from ai import AIRandom, AISmart, _generate_valid_moves, _get_random_move, _sample_board_configuration, \
+    _determinization_inputs, _update_beliefs, _playout
+from rollout import ROLLOUT_POLICIES, Cutoff
+from rank import Rank, beats, beaten_by
+from sampler import DeterminizationSampler
+from zobrist import TranspositionTable
+
+
+# plays a seeded random game for up to plies moves, recording player 1's initial board and every move
+def _record_game(seed, plies):
+    random.seed(seed)
+    gog = GOG()
+    ais = {1: AIRandom(1), 2: AISmart(2)}
+    for player in [1, 2]:
+        ais[player].set_pov(gog.set_player_pieces(ais[player].get_init_form(), player))
+    initial_board = [row[:] for row in gog.board]
+    ais[2].enemy_set_pieces()
+    moves = []
+    events = []
+    while not gog.victor and len(moves) < plies:
+        player = gog.current_turn
+        move = _get_random_move(ais[player]._pov, player)
+        event = gog.move(move[0], move[1], player)
+        moves.append(event[0][1])
+        events.append((event[0][2], event[1]))
+        ais[2].board_event(events[-1])
+    return gog, ais[2], initial_board, moves, events
+
+
+# the set based belief state that AISmart used before Beliefs, kept here with its updates to benchmark against
+def _possibilities(ai):
+    return SimpleNamespace(_player=ai._player, _pov=ai._pov,
+                           _possible_ranks_per_piece={p: set(Rank) for p in ai._enemy_pieces},
+                           _possible_pieces_per_rank={r: set(ai._enemy_pieces) for r in Rank})
+
+
+def _update_possibilities(self, event):
+    eliminated_pieces = event[1]
+    if not eliminated_pieces:
+        return
+    move = event[0]
+    if len(eliminated_pieces) == 2:
+        own_piece = eliminated_pieces[0] if eliminated_pieces[0].player == self._player else eliminated_pieces[1]
+        enemy_piece = eliminated_pieces[0] if eliminated_pieces[0].player != self._player else eliminated_pieces[1]
+        for rank in self._possible_ranks_per_piece[enemy_piece]:
+            if rank == own_piece.rank: continue
+            self._possible_pieces_per_rank[rank].remove(enemy_piece)
+        self._possible_ranks_per_piece[enemy_piece] = {own_piece.rank}
+    else:
+        enemy_piece = eliminated_pieces[0] if eliminated_pieces[0].player != self._player else \
+            self._pov[move[1][0]][move[1][1]]
+        own_piece = eliminated_pieces[0] if eliminated_pieces[0].player == self._player else \
+            self._pov[move[1][0]][move[1][1]]
+        duel_dict = beats if enemy_piece is eliminated_pieces[0] else beaten_by
+        enemy_piece_cannot_be = duel_dict[own_piece.rank] | {own_piece.rank}
+        for rank in enemy_piece_cannot_be:
+            if rank in self._possible_ranks_per_piece[enemy_piece]:
+                self._possible_pieces_per_rank[rank].remove(enemy_piece)
+        self._possible_ranks_per_piece[enemy_piece] -= enemy_piece_cannot_be
+        self._possible_ranks_per_piece[enemy_piece].discard(Rank.FLAG)
+
+    _clean_possibilities(self)
+
+
+def _clean_possibilities(self):
+    modified = True
+    while modified:
+        modified = False
+        for piece, ranks in self._possible_ranks_per_piece.items():
+            if len(ranks) == 1:
+                for rank in ranks:
+                    modified = _update_pieces_from_clean(self, rank)
+                if modified: break
+        for rank, pieces in self._possible_pieces_per_rank.items():
+            if (rank != Rank.PRIVATE and rank != Rank.SPY and len(pieces) == 1) or (rank == Rank.PRIVATE and
+                                                                                    len(pieces) == 6) \
+                    or (rank == Rank.SPY and len(pieces) == 2):
+                modified = modified or _update_ranks_from_clean(self, rank, pieces)
+                if modified: break
+
+
+def _update_ranks_from_clean(self, rank, pieces):
+    modified = False
+    for piece in pieces:
+        if len(self._possible_ranks_per_piece[piece]) != 1:
+            for piece_probable_rank in self._possible_ranks_per_piece[piece]:
+                if piece_probable_rank == rank: continue
+                self._possible_pieces_per_rank[piece_probable_rank].discard(piece)
+            self._possible_ranks_per_piece[piece] = {rank}
+            modified = True
+    return modified
+
+
+def _update_pieces_from_clean(self, rank):
+    sure_pieces = set()
+    modified = False
+    for piece in self._possible_pieces_per_rank[rank]:
+        if len(self._possible_ranks_per_piece[piece]) == 1:
+            sure_pieces.add(piece)
+    if len(sure_pieces) == player_pieces[rank]:
+        if len(self._possible_pieces_per_rank[rank]) != player_pieces[rank]:
+            for piece in self._possible_pieces_per_rank[rank]:
+                if piece in sure_pieces: continue
+                self._possible_ranks_per_piece[piece].discard(rank)
+            self._possible_pieces_per_rank[rank] = sure_pieces
+            modified = True
+    return modified
+
+
+# replays the recorded game from player 2's point of view and times only the belief updates
+def _replay_beliefs(initial_board, events, update):
+    ai = AISmart(2)
+    pov = [row[::-1] for row in initial_board[::-1]]
+    board_manager = BoardManager(pov)
+    ai.set_pov(pov)
+    ai.enemy_set_pieces()
+    state = ai if update is _update_beliefs else _possibilities(ai)
+    elapsed = 0
+    for event in events:
+        board_manager.move(event[0])
+        start = time.perf_counter()
+        update(state, event)
+        elapsed += time.perf_counter() - start
+    return elapsed, state
+
+
+def _time(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _result(samples, calls_per_sample):
+    per_call = [x / calls_per_sample for x in samples]
+    return {
+        'samples': len(samples),
+        'calls_per_sample': calls_per_sample,
+        'min_s': min(per_call),
+        'median_s': median(per_call),
+        'max_s': max(per_call),
+    }
+
+
+def micro_benchmarks(seed, repeat):
+    results = {}
+    gog, ai, initial_board, moves, events = _record_game(seed, 200)
+    povs = [_record_game(seed + i, plies)[1]._pov for i, plies in enumerate((0, 40, 120))]
+
+    def board_manager_move():
+        board_manager = BoardManager([row[:] for row in initial_board])
+        start = time.perf_counter()
+        for move in moves:
+            board_manager.move(move)
+        return time.perf_counter() - start
+    results['board_manager_move'] = _result([board_manager_move() for _ in range(repeat)], len(moves))
+
+    # the same moves through GOG, whose board player 2 sees through a rotated view; player 2's moves are given in
+    # its own coordinates
+    def gog_move():
+        replay = GOG()
+        for player in [1, 2]:
+            replay.set_player_pieces(gog.formations[player], player)
+        player_moves = [move if ply % 2 == 0 else tuple((7 - r, 8 - c) for r, c in move)
+                        for ply, move in enumerate(moves)]
+        start = time.perf_counter()
+        for ply, move in enumerate(player_moves):
+            replay.move(move[0], move[1], 1 + ply % 2)
+        return time.perf_counter() - start
+    results['gog_move'] = _result([gog_move() for _ in range(repeat)], len(moves))
+
+    results['generate_valid_moves'] = _result(
+        _time(lambda: [_generate_valid_moves(pov, p) for pov in povs for p in [1, 2]], repeat), len(povs) * 2)
+    # the reads of the rotated view: player 2's moves generated on the view itself and on a copy of it, as the AI
+    # takes once per turn
+    results['generate_valid_moves_rotated_view'] = _result(
+        _time(lambda: [_generate_valid_moves(pov, 2) for pov in povs], repeat), len(povs))
+    results['generate_valid_moves_rotated_copy'] = _result(
+        _time(lambda: [_generate_valid_moves([row[:] for row in pov], 2) for pov in povs], repeat), len(povs))
+    results['get_random_move'] = _result(
+        _time(lambda: [_get_random_move(pov, p) for pov in povs for p in [1, 2]], repeat), len(povs) * 2)
+
+    own_pieces_board, enemy_pieces, sampler = _determinization_inputs(ai._pov, 2, ai._beliefs.ranks)
+    rng = random.Random(seed)
+    results['generate_valid_board_configuration'] = _result(
+        _time(lambda: [_sample_board_configuration(own_pieces_board, enemy_pieces, sampler, 1, rng)
+                       for _ in range(100)], repeat), 100)
+    masks = ai._beliefs.ranks[:]
+    results['determinization_sampler'] = _result(_time(lambda: DeterminizationSampler(masks), repeat), 1)
+
+    for name, update in (('update_possibilities', _update_possibilities), ('update_beliefs', _update_beliefs)):
+        results[name] = _result([_replay_beliefs(initial_board, events, update)[0] for _ in range(repeat)],
+                                len(events))
+    possibilities = _replay_beliefs(initial_board, events, _update_possibilities)[1]
+    results['clean_possibilities'] = _result(_time(lambda: _clean_possibilities(possibilities), repeat), 1)
+    return results
+
+
+def search_benchmarks(seed, repeat, searches):
+    results = {}
+    for plies in (0, 40, 120):
+        _, ai, _, _, _ = _record_game(seed + plies, plies)
+        for search in searches:
+            smart = AISmart(2, search=search)
+            smart._pov = ai._pov
+            smart._enemy_pieces = ai._enemy_pieces
+            smart._beliefs = ai._beliefs
+
+            def get_move():
+                random.seed(seed)
+                smart._tree = AISmart.TreeSearch(2) if search == 'tree' else None
+                smart._table = TranspositionTable() if search == 'expectiminimax' else None
+                smart.get_move()
+            results['get_move_%s_ply_%d' % (search, plies)] = _result(_time(get_move, repeat), 1)
+    return results
+
+
+# counts the plies of the playouts it plays
+class _CountingPolicy:
+    def __init__(self, policy):
+        self._policy = policy
+        self.plies = 0
+
+    def choose(self, squares, player, valid_moves, rng):
+        self.plies += 1
+        return self._policy.choose(squares, player, valid_moves, rng)
+
+
+# time per playout, average and longest playout of every rollout policy, with and without a cutoff, from the
+# positions of search_benchmarks
+def rollout_benchmarks(seed, repeat, playouts=100):
+    results = {}
+    for plies in (0, 40, 120):
+        _, ai, _, _, _ = _record_game(seed + plies, plies)
+        own_pieces_board, enemy_pieces, sampler = _determinization_inputs(ai._pov, 2, ai._beliefs.ranks)
+        for name in ROLLOUT_POLICIES:
+            for suffix, cutoff in (('', None), ('_cutoff', Cutoff(80, True))):
+                policy = _CountingPolicy(ROLLOUT_POLICIES[name])
+                rng = random.Random(seed)
+                longest = 0
+
+                def play():
+                    nonlocal longest
+                    for _ in range(playouts):
+                        start = policy.plies
+                        _playout(_sample_board_configuration(own_pieces_board, enemy_pieces, sampler, 1, rng), 1,
+                                 rng, policy, cutoff)
+                        longest = max(longest, policy.plies - start)
+                result = _result(_time(play, repeat), playouts)
+                result['average_plies'] = policy.plies / (repeat * playouts)
+                result['longest_plies'] = longest
+                results['playout_%s%s_ply_%d' % (name, suffix, plies)] = result
+    return results
+
+
+# returns the benchmarks whose median got slower than the baseline by more than threshold (0.2 is 20%)
+def regressions(current, baseline, threshold):
+    slower = {}
+    for name, result in current['results'].items():
+        if name in baseline['results']:
+            ratio = result['median_s'] / baseline['results'][name]['median_s']
+            if ratio > 1 + threshold:
+                slower[name] = ratio
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Engine and AI benchmarks with JSON output.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--searches', nargs='*', default=['monte_carlo', 'tree', 'expectiminimax'])
+    parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+    parser.add_argument('--compare', help='baseline JSON produced by an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'seed': args.seed,
+        'timestamp': time.time(),
+        'results': {**micro_benchmarks(args.seed, args.repeat),
+                    **search_benchmarks(args.seed, args.repeat, args.searches),
+                    **rollout_benchmarks(args.seed, args.repeat)},
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            slower = regressions(report, json.load(f), args.threshold)
+        for name, ratio in slower.items():
+            print('%s is %.2fx slower than the baseline' % (name, ratio), file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
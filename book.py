@@ -0,0 +1,53 @@
+import os
+import random
+
+from rank import Rank
+
+BOOK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'opening_book.txt')
+
+
+# a formation is written as 27 characters, row by row as given to GOG.set_player_pieces, each the hex value of a
+# rank or '.' for an empty square
+def format_formation(formation):
+    return ''.join('.' if rank is None else format(rank.value, 'x') for row in formation for rank in row)
+
+
+def parse_formation(text):
+    ranks = [None if x == '.' else Rank(int(x, 16)) for x in text]
+    return [ranks[9 * i: 9 * (i + 1)] for i in range(3)]
+
+
+# one formation per line followed by the score formation.py gave it
+def save(entries, path=BOOK_FILE):
+    with open(path, 'w') as f:
+        for formation, score in entries:
+            f.write(f'{format_formation(formation)} {score:.4f}\n')
+
+
+def load(path=BOOK_FILE):
+    if not os.path.exists(path):
+        return []
+    entries = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                text, score = line.split()
+                entries.append((parse_formation(text), float(score)))
+    return entries
+
+
+_formations = None
+
+
+# a formation from the book, or None if there is no book. The board is symmetric left to right, so a formation
+# is mirrored half the time for variety.
+def sample_formation(rng=random):
+    global _formations
+    if _formations is None:
+        _formations = [formation for formation, _ in load()]
+    if not _formations:
+        return None
+    formation = rng.choice(_formations)
+    if rng.random() < 0.5:
+        return [row[::-1] for row in formation]
+    return [row[:] for row in formation]
@@ -0,0 +1,174 @@
+from rank import Rank, DUEL, WIN, DRAW
+from gog import Piece
+import zobrist
+from topology import ROWS, COLS, SQUARES, NEIGHBORS, square_index, square_pos
+
+EMPTY = 0
+PLAYER_SHIFT = 4
+RANK_MASK = 0xf
+FLAG = Rank.FLAG.value
+
+
+def encode(rank, player):
+    return player << PLAYER_SHIFT | rank.value
+
+
+def decode(code):
+    if code == EMPTY:
+        return None
+    return Rank(code & RANK_MASK), code >> PLAYER_SHIFT
+
+
+# the squares of a board set up with both formations, as given to GOG.set_player_pieces
+def initial_squares(formations):
+    squares = bytearray(SQUARES)
+    for i in range(3):
+        for j in range(9):
+            for player, row, col in ((1, i, j), (2, 7 - i, 8 - j)):
+                rank = formations[player][i][j]
+                if rank is not None:
+                    squares[row * COLS + col] = encode(rank, player)
+    return squares
+
+
+
+class CompactBoardManager:
+    # view picks the zobrist keys: 0 hashes every rank, player p hashes only the ranks p can see
+    def __init__(self, squares, victor=0, winning=None, occupied=None, view=zobrist.FULL_VIEW, hashes=None):
+        assert len(squares) == SQUARES
+        self.squares = squares
+        self.victor = victor
+        self._winning = winning if winning is not None else [False, False, False]
+        if occupied is None:
+            occupied = [None, set(), set()]
+            for idx, code in enumerate(squares):
+                if code:
+                    occupied[code >> PLAYER_SHIFT].add(idx)
+        self.occupied = occupied
+        self.view = view
+        self._keys = zobrist.KEYS[view]
+        self._mirror_keys = zobrist.MIRROR_KEYS[view]
+        if hashes is None:
+            hashes = zobrist.hash_squares(squares, self._keys), zobrist.hash_squares(squares, self._mirror_keys)
+            for player in [1, 2]:
+                if self._winning[player]:
+                    hashes = hashes[0] ^ zobrist.WINNING_KEYS[player], hashes[1] ^ zobrist.WINNING_KEYS[player]
+        self.hash, self.mirror_hash = hashes
+
+    @classmethod
+    def from_board(cls, board, view=zobrist.FULL_VIEW):
+        squares = bytearray(SQUARES)
+        for i, row in enumerate(board):
+            for j, square in enumerate(row):
+                if square:
+                    squares[i * COLS + j] = encode(square.rank, square.player)
+        return cls(squares, view=view)
+
+    def to_board(self):
+        board = [[None] * COLS for _ in range(ROWS)]
+        for idx, code in enumerate(self.squares):
+            if code:
+                board[idx // COLS][idx % COLS] = Piece(Rank(code & RANK_MASK), code >> PLAYER_SHIFT)
+        return board
+
+    def copy(self):
+        return CompactBoardManager(self.squares[:], self.victor, self._winning[:],
+                                   [None, self.occupied[1].copy(), self.occupied[2].copy()], self.view,
+                                   (self.hash, self.mirror_hash) if self._keys else None)
+
+    def place(self, index, code):
+        assert not self.squares[index]
+        self.squares[index] = code
+        self.occupied[code >> PLAYER_SHIFT].add(index)
+        if self._keys:
+            self.hash ^= self._keys[index][code]
+            self.mirror_hash ^= self._mirror_keys[index][code]
+
+    # playouts throw the board away afterwards, so they skip keeping the hashes up to date
+    def stop_hashing(self):
+        self._keys = self._mirror_keys = None
+        self.hash = self.mirror_hash = None
+
+    # hash of the position with player to move
+    def position_hash(self, player):
+        turn = zobrist.TURN_KEY if player == 2 else 0
+        return self.hash ^ turn, self.mirror_hash ^ turn
+
+    def get_victor(self):
+        return self.victor
+
+    def move(self, move):
+        return self.move_squares(square_index(move[0]), square_index(move[1]))
+
+    def move_squares(self, src, dst):
+        squares = self.squares
+        occupied = self.occupied
+        mover = squares[src]
+        assert mover
+        target = squares[dst]
+        player = mover >> PLAYER_SHIFT
+        other_player = 1 if player == 2 else 2
+        eliminated_pieces = None
+        if target:
+            mover_rank = mover & RANK_MASK
+            target_rank = target & RANK_MASK
+            outcome = DUEL[mover_rank][target_rank]
+            if outcome == WIN:
+                if target_rank == FLAG:
+                    self.victor = player
+                eliminated_pieces = target,
+                squares[dst] = mover
+                squares[src] = EMPTY
+                occupied[other_player].remove(dst)
+                occupied[player].remove(src)
+                occupied[player].add(dst)
+            elif outcome == DRAW:
+                eliminated_pieces = mover, target
+                squares[dst] = EMPTY
+                squares[src] = EMPTY
+                occupied[other_player].remove(dst)
+                occupied[player].remove(src)
+            else:
+                if mover_rank == FLAG:
+                    self.victor = other_player
+                eliminated_pieces = mover,
+                squares[src] = EMPTY
+                occupied[player].remove(src)
+        else:
+            squares[dst] = mover
+            squares[src] = EMPTY
+            occupied[player].remove(src)
+            occupied[player].add(dst)
+            row = dst // COLS
+            if mover & RANK_MASK == FLAG and ((row == 0 and player == 2) or (row == ROWS - 1 and player == 1)):
+                col = dst % COLS
+                no_enemy_piece_is_currently_beside_flag = \
+                    (col == 0 or squares[dst - 1] >> PLAYER_SHIFT != other_player) \
+                    and (col == COLS - 1 or squares[dst + 1] >> PLAYER_SHIFT != other_player)
+                if no_enemy_piece_is_currently_beside_flag:
+                    self.victor = player
+                else:
+                    self._winning[player] = True
+                    if self._keys:
+                        self.hash ^= zobrist.WINNING_KEYS[player]
+                        self.mirror_hash ^= zobrist.WINNING_KEYS[player]
+        if self._winning[other_player] and not self.victor:
+            self.victor = other_player
+        # the source square is always empty afterwards
+        keys = self._keys
+        if keys:
+            mirror_keys = self._mirror_keys
+            self.hash ^= keys[src][mover] ^ keys[dst][target] ^ keys[dst][squares[dst]]
+            self.mirror_hash ^= mirror_keys[src][mover] ^ mirror_keys[dst][target] ^ mirror_keys[dst][squares[dst]]
+        return eliminated_pieces
+
+
+def generate_valid_moves(squares, player, occupied=None):
+    valid_moves = []
+    if occupied is None:
+        occupied = [idx for idx, code in enumerate(squares) if code >> PLAYER_SHIFT == player]
+    for src in occupied:
+        for dst in NEIGHBORS[src]:
+            if squares[dst] >> PLAYER_SHIFT != player:
+                valid_moves.append((src, dst))
+    return valid_moves
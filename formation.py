@@ -0,0 +1,88 @@
+import argparse
+import json
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import book
+from ai import generate_random_init_form
+from compact import SQUARES, initial_squares
+
+
+# plays every candidate against every opponent formation from both seats with batched random playouts and returns
+# the share of points each candidate won; a game cut off at max_plies is worth half a point
+def score_formations(candidates, opponents, seed, max_plies=300):
+    # numpy is only needed for scoring, so the book can be read and formations swapped without it
+    import numpy as np
+    from batch import BatchSimulator
+
+    boards = []
+    for candidate in candidates:
+        for opponent in opponents:
+            boards.append(initial_squares({1: candidate, 2: opponent}))
+            boards.append(initial_squares({1: opponent, 2: candidate}))
+    board = np.frombuffer(b''.join(boards), dtype=np.int8).reshape(len(boards), SQUARES).copy()
+    simulator = BatchSimulator(board, np.ones(len(boards), dtype=np.int8))
+    victor = simulator.run(np.random.default_rng(seed), max_plies).reshape(len(candidates), len(opponents), 2)
+    wins = (victor[:, :, 0] == 1).sum(axis=1) + (victor[:, :, 1] == 2).sum(axis=1)
+    draws = (victor == 0).sum(axis=(1, 2))
+    return ((wins + draws / 2) / (2 * len(opponents))).tolist()
+
+
+# swaps two squares of the formation that hold different ranks (or a rank and an empty square)
+def swap(formation, rng):
+    squares = [rank for row in formation for rank in row]
+    while True:
+        i, j = rng.sample(range(len(squares)), 2)
+        if squares[i] != squares[j]:
+            break
+    squares[i], squares[j] = squares[j], squares[i]
+    return [squares[9 * k: 9 * (k + 1)] for k in range(3)]
+
+
+# hill climbs from a random formation. Every step scores the current formation and its neighbors on the same
+# fresh opponents and moves to the best of them, and the result is scored again on opponents it never saw.
+def optimize(seed, iterations=30, neighbors=6, games=128, max_plies=300):
+    rng = random.Random(seed)
+    formation = generate_random_init_form(rng)
+    for _ in range(iterations):
+        candidates = [formation] + [swap(formation, rng) for _ in range(neighbors)]
+        opponents = [generate_random_init_form(rng) for _ in range(games)]
+        scores = score_formations(candidates, opponents, rng.getrandbits(64), max_plies)
+        formation = candidates[max(range(len(candidates)), key=scores.__getitem__)]
+    opponents = [generate_random_init_form(rng) for _ in range(4 * games)]
+    return formation, score_formations([formation], opponents, rng.getrandbits(64), max_plies)[0]
+
+
+def _optimize(args):
+    return optimize(*args)
+
+
+# optimizes size formations, one per process at a time, best first
+def build_book(size, workers=1, seed=0, iterations=30, neighbors=6, games=128, max_plies=300):
+    jobs = [(seed + i, iterations, neighbors, games, max_plies) for i in range(size)]
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            entries = list(executor.map(_optimize, jobs))
+    else:
+        entries = [_optimize(job) for job in jobs]
+    return sorted(entries, key=lambda entry: -entry[1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the opening book of initial formations offline.')
+    parser.add_argument('--size', type=int, default=16, help='number of formations in the book')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=30, help='hill climbing steps per formation')
+    parser.add_argument('--neighbors', type=int, default=6, help='swaps tried per step')
+    parser.add_argument('--games', type=int, default=128, help='opponent formations per step, played from both seats')
+    parser.add_argument('--max-plies', type=int, default=300)
+    parser.add_argument('--output', default=book.BOOK_FILE)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    entries = build_book(args.size, args.workers, args.seed, args.iterations, args.neighbors, args.games,
+                         args.max_plies)
+    book.save(entries, args.output)
+    print(json.dumps({'formations': len(entries), 'scores': [round(score, 4) for _, score in entries],
+                      'seconds': round(time.perf_counter() - start, 1)}, indent=2))
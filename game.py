@@ -1,17 +1,23 @@
 import pygame
 import sys
-from threading import Thread
 from rank import Rank
 from ai import generate_random_init_form
-pygame.init()
+import book
+from topology import NEIGHBOR_POSITIONS
 
 SQUARE_DIM = 90
 PIECE_WIDTH = 80
 PIECE_HEIGHT = 48
 PADDING = 3
-SCREEN = pygame.display.set_mode((PADDING * 10 + SQUARE_DIM * 9, PADDING * 9 + SQUARE_DIM * 8))
+SCREEN_SIZE = (PADDING * 10 + SQUARE_DIM * 9, PADDING * 9 + SQUARE_DIM * 8)
+# posted by the AI worker's listener thread once its move is ready
+AI_MOVE_EVENT = pygame.USEREVENT + 1
+# the window and the images are only set up once a game is shown, see init_display
+SCREEN = None
+ENEMY_PIECE_IMG = None
+RANK_IMG = {}
 
-RANK_IMG = {
+RANK_IMG_FILES = {
     Rank.FLAG: 'flag.png',
     Rank.SPY: 'spy.png',
     Rank.PRIVATE: 'private.png',
@@ -29,10 +35,20 @@ RANK_IMG = {
     Rank.GENERAL_FIVE: 'general5.jpg',
 }
 
-ENEMY_PIECE_IMG = pygame.transform.smoothscale(pygame.image.load('./assets/image0.jpeg'), (PIECE_WIDTH, PIECE_HEIGHT))
 
-for rank, file in RANK_IMG.items():
-    RANK_IMG[rank] = pygame.transform.smoothscale(pygame.image.load(f'./assets/{file}'), (PIECE_WIDTH, PIECE_HEIGHT))
+def _load_piece_image(file):
+    return pygame.transform.smoothscale(pygame.image.load(f'./assets/{file}'), (PIECE_WIDTH, PIECE_HEIGHT))
+
+
+def init_display():
+    global SCREEN, ENEMY_PIECE_IMG
+    if SCREEN is not None:
+        return
+    pygame.init()
+    SCREEN = pygame.display.set_mode(SCREEN_SIZE)
+    ENEMY_PIECE_IMG = _load_piece_image('image0.jpeg')
+    for rank, file in RANK_IMG_FILES.items():
+        RANK_IMG[rank] = _load_piece_image(file)
 
 
 class Square:
@@ -45,8 +61,12 @@ class Square:
         self.row = row
         self.col = col
 
-    def draw_square(self):
-        pygame.draw.rect(SCREEN, (108, 0, 0), self._rect)
+    @property
+    def rect(self):
+        return self._rect
+
+    def draw_square(self, surface=None):
+        pygame.draw.rect(surface or SCREEN, (108, 0, 0), self._rect)
 
     def draw_piece(self, surface):
         rect = surface.get_rect(center=(self._rect.left + SQUARE_DIM / 2, self._rect.top + SQUARE_DIM / 2))
@@ -64,8 +84,9 @@ class Square:
 
 class Game:
     def __init__(self, gog, ai):
+        init_display()
         self._gog = gog
-        self._init_form = generate_random_init_form()
+        self._init_form = book.sample_formation() or generate_random_init_form()
         self._squares = []
         self._started = False
         self._selected_square = None
@@ -98,13 +119,13 @@ class Game:
         self._restart_button_rect.height = self._restart_text_rect.height + 20
         self._restart_button_rect.center = self._restart_text_rect.center
         self._calculating_text_surface = pygame.font.SysFont('comicsansms', 30).render('enemy thinking xd', True, (255, 255, 255))
-        self._calculating_text_rect = self._calculating_text_surface.get_rect(center=(((10 * PADDING + 9 * SQUARE_DIM) / 2), (9 * PADDING + 8 * SQUARE_DIM) / 2)),
+        self._calculating_text_rect = self._calculating_text_surface.get_rect(center=(((10 * PADDING + 9 * SQUARE_DIM) / 2), (9 * PADDING + 8 * SQUARE_DIM) / 2))
         self._pov = None
+        # an AIWorker, so that the AI thinks in its own process
         self._ai = ai
+        self._ai.on_move = lambda move: pygame.event.post(pygame.event.Event(AI_MOVE_EVENT, move=move))
         self._restart = False
-        self._exit = False
         self._get_ai_move = False
-        self._ai_move = None
         for i in range(8):
             row = []
             for j in range(9):
@@ -115,30 +136,29 @@ class Game:
                     j,
                 ))
             self._squares.append(row)
-
-    def _draw_board(self):
-        SCREEN.fill((18, 0, 0))
+        # the empty board is rendered once; every frame only repaints the regions whose contents changed
+        self._background = pygame.Surface(SCREEN_SIZE)
+        self._background.fill((18, 0, 0))
         for row in self._squares:
             for square in row:
-                square.draw_square()
-        if self._highlight_orange:
-            for square in self._highlight_orange:
-                square.color((255, 77, 0))
-        if self._highlight_green:
-            for square in self._highlight_green:
-                square.color((12, 255, 0))
+                square.draw_square(self._background)
+        self._drawn_squares = None
+        self._drawn_overlays = None
+
+    # (fill color, outline color, piece image) of every square, None where the background shows through
+    def _square_states(self):
+        states = [[[None, None, None] for _ in row] for row in self._squares]
+        for square in self._highlight_orange:
+            states[square.row][square.col][0] = (255, 77, 0)
+        for square in self._highlight_green:
+            states[square.row][square.col][0] = (12, 255, 0)
         if self._selected_square:
-            self._selected_square.outline_piece((12, 255, 0))
+            states[self._selected_square.row][self._selected_square.col][1] = (12, 255, 0)
         if not self._started:
-            pygame.draw.rect(SCREEN, (100, 100, 100), self._ready_button_rect)
-            if self._glow_ready:
-                SCREEN.blit(self._ready_text_glow_surface, self._ready_text_rect)
-            else:
-                SCREEN.blit(self._ready_text_surface, self._ready_text_rect)
             for i, row in enumerate(self._init_form):
                 for j, square in enumerate(row):
                     if square is not None:
-                        self._squares[7-i][8-j].draw_piece(RANK_IMG[square])
+                        states[7-i][8-j][2] = RANK_IMG[square]
         else:
             assert self._pov
             for i, row in enumerate(self._pov):
@@ -146,39 +166,73 @@ class Game:
                     if square is not None:
                         if square.player == 2:
                             if self._gog.victor:
-                                self._squares[7-i][8-j].outline_piece((255, 55, 54))
-                                self._squares[7-i][8-j].draw_piece(RANK_IMG[square.rank])
+                                states[7-i][8-j][1] = (255, 55, 54)
+                                states[7-i][8-j][2] = RANK_IMG[square.rank]
                             else:
-                                self._squares[7-i][8-j].draw_piece(ENEMY_PIECE_IMG)
+                                states[7-i][8-j][2] = ENEMY_PIECE_IMG
                         else:
-                            self._squares[7-i][8-j].draw_piece(RANK_IMG[square.rank])
-            if self._get_ai_move:
-                SCREEN.blit(self._calculating_text_surface, self._calculating_text_rect)
+                            states[7-i][8-j][2] = RANK_IMG[square.rank]
+        return [[tuple(state) for state in row] for row in states]
+
+    # (button rect or None, text surface, text rect) of everything drawn over the squares, bottom first
+    def _overlays(self):
+        overlays = []
+        if not self._started:
+            overlays.append((self._ready_button_rect, self._ready_text_glow_surface if self._glow_ready
+                             else self._ready_text_surface, self._ready_text_rect))
+        elif self._get_ai_move:
+            overlays.append((None, self._calculating_text_surface, self._calculating_text_rect))
         if self._gog.victor:
-            SCREEN.blit(self._outcome_text_surface[self._gog.victor], self._outcome_rect[self._gog.victor])
-            pygame.draw.rect(SCREEN, (100, 100, 100), self._restart_button_rect)
-            if self._glow_restart:
-                SCREEN.blit(self._restart_text_glow_surface, self._restart_text_rect)
-            else:
-                SCREEN.blit(self._restart_text_surface, self._restart_text_rect)
+            overlays.append((None, self._outcome_text_surface[self._gog.victor], self._outcome_rect[self._gog.victor]))
+            overlays.append((self._restart_button_rect, self._restart_text_glow_surface if self._glow_restart
+                             else self._restart_text_surface, self._restart_text_rect))
+        return overlays
 
-        pygame.display.flip()
+    def _draw_board(self):
+        squares = self._square_states()
+        overlays = self._overlays()
+        if self._drawn_squares is None:
+            dirty = [SCREEN.get_rect()]
+        else:
+            dirty = [square.rect for row in self._squares for square in row
+                     if squares[square.row][square.col] != self._drawn_squares[square.row][square.col]]
+            for overlay in overlays + self._drawn_overlays:
+                if (overlay in overlays) != (overlay in self._drawn_overlays):
+                    dirty.append(overlay[0] or overlay[2])
+        self._drawn_squares = squares
+        self._drawn_overlays = overlays
+        if not dirty:
+            return
+        # every dirty region is repainted from the background up, clipped so nothing outside it is drawn twice
+        for rect in dirty:
+            SCREEN.set_clip(rect)
+            SCREEN.blit(self._background, rect, rect)
+            for row in self._squares:
+                for square in row:
+                    if not square.rect.colliderect(rect):
+                        continue
+                    fill, outline, image = squares[square.row][square.col]
+                    if fill:
+                        square.color(fill)
+                    if outline:
+                        square.outline_piece(outline)
+                    if image:
+                        square.draw_piece(image)
+            for button_rect, surface, text_rect in overlays:
+                if button_rect:
+                    pygame.draw.rect(SCREEN, (100, 100, 100), button_rect)
+                SCREEN.blit(surface, text_rect)
+        SCREEN.set_clip(None)
+        pygame.display.update(dirty)
 
     def start(self):
-        ai_thread = Thread(target=self._compute_ai_move)
-        ai_thread.start()
-        self._run()
-        ai_thread.join(0)
+        try:
+            self._run()
+        finally:
+            # also cancels the AI's search if the game is left while it is thinking
+            self._ai.close()
         return self._restart
 
-    def _compute_ai_move(self):
-        while not self._restart and not self._exit:
-            if not self._get_ai_move:
-                continue
-            move = self._ai.get_move()
-            self._ai_move = move
-            self._get_ai_move = False
-
     def _run(self):
         self._ai.set_pov(self._gog.set_player_pieces(self._ai.get_init_form(), 2))
 
@@ -223,11 +277,12 @@ class Game:
         def main_tick(event):
             assert self._pov
             assert self._started
-            if self._ai_move:
-                next_event = self._gog.move(self._ai_move[0], self._ai_move[1], 2)
+            if event.type == AI_MOVE_EVENT:
+                next_event = self._gog.move(event.move[0], event.move[1], 2)
                 self._ai.board_event((next_event[0][2], next_event[1]))
-                self._highlight_orange = [self._squares[x][y] for x, y in self._ai_move]
-                self._ai_move = None
+                self._highlight_orange = [self._squares[x][y] for x, y in event.move]
+                self._get_ai_move = False
+                return
             if self._gog.current_turn != 1 or self._get_ai_move:
                 return
             elif event.type == pygame.MOUSEBUTTONDOWN:
@@ -242,7 +297,9 @@ class Game:
                                                            (7 - i, 8 - j), 1)
                     if game_event:
                         self._ai.board_event((game_event[0][2], game_event[1]))
-                        self._get_ai_move = True
+                        if not self._gog.victor:
+                            self._ai.request_move()
+                            self._get_ai_move = True
                         self._highlight_orange = []
                     self._selected_square = None
                     self._highlight_green = []
@@ -255,9 +312,9 @@ class Game:
                                 self._selected_square = square
                     if self._selected_square:
                         highlight = []
-                        for dr, dc in ((0, 1), (1, 0), (0, -1), (-1, 0)):
-                            if self._is_valid_destination(7 - self._selected_square.row - dr, 8 - self._selected_square.col - dc):
-                                highlight.append(self._squares[self._selected_square.row + dr][self._selected_square.col + dc])
+                        for row, col in NEIGHBOR_POSITIONS[7 - self._selected_square.row][8 - self._selected_square.col]:
+                            if self._is_valid_destination(row, col):
+                                highlight.append(self._squares[7 - row][8 - col])
                         self._highlight_green = highlight
         self._run_ticks(main_tick, lambda: not self._gog.victor)
 
@@ -280,10 +337,12 @@ class Game:
             clock.tick(60)
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
-                    self._exit = True
                     sys.exit()
+                # only changed regions are pushed to the screen, so an uncovered window is drawn again in full
+                if event.type in (pygame.WINDOWEXPOSED, pygame.VIDEOEXPOSE):
+                    self._drawn_squares = None
                 tick(event)
 
     def _is_valid_destination(self, row, col):
-        return 0 <= row < 8 and 0 <= col < 9 and (not self._pov[row][col] or self._pov[row][col].player == 2)
+        return not self._pov[row][col] or self._pov[row][col].player == 2
 
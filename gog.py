@@ -1,6 +1,9 @@
+import operator
 from functools import reduce
 
-from rank import Rank, beaten_by
+from rank import Rank, DUEL, WIN, DRAW
+import zobrist
+from topology import ADJACENT, square_index
 
 player_pieces = {
     Rank.FLAG: 1,
@@ -21,10 +24,27 @@ player_pieces = {
 }
 
 
+PIECES_PER_PLAYER = sum(player_pieces.values())
+
+
+# Player 1's pieces have the ids 0 to 20 and player 2's pieces 21 to 41, numbered in the order set_player_pieces
+# reads the formation, which is public. Per piece state can then live in flat arrays indexed by id. Pieces are
+# still told apart by identity, so they are not shared between squares.
 class Piece:
-    def __init__(self, rank, player):
+    __slots__ = 'rank', 'player', 'id'
+
+    def __init__(self, rank, player, piece_id=None):
         self.rank = rank
         self.player = player
+        self.id = piece_id
+
+
+def first_piece_id(player):
+    return PIECES_PER_PLAYER * (player - 1)
+
+
+def _piece_code(piece):
+    return piece.player << 4 | piece.rank.value if piece else 0
 
 
 class BoardManager:
@@ -48,25 +68,42 @@ class BoardManager:
         self.board = board
         self._winning = {1: False, 2: False}
         self.victor = 0
+        self.hash = 0
+        self.mirror_hash = 0
+        for i, row in enumerate(board):
+            for j, square in enumerate(row):
+                if square:
+                    self._update_hash((i, j), None)
+
+    # xors the piece that left pos out of the hashes and the piece now on pos in
+    def _update_hash(self, pos, old):
+        index = square_index(pos)
+        change = _piece_code(old), _piece_code(self.board[pos[0]][pos[1]])
+        self.hash ^= zobrist.KEYS[zobrist.FULL_VIEW][index][change[0]] ^ \
+            zobrist.KEYS[zobrist.FULL_VIEW][index][change[1]]
+        self.mirror_hash ^= zobrist.MIRROR_KEYS[zobrist.FULL_VIEW][index][change[0]] ^ \
+            zobrist.MIRROR_KEYS[zobrist.FULL_VIEW][index][change[1]]
 
     def get_victor(self):
         return self.victor
 
     def move(self, move):
-        pos1, pos2 = move
+        pos1, pos2 = (move[0][0], move[0][1]), (move[1][0], move[1][1])
         assert self.board[pos1[0]][pos1[1]]
         player = self.board[pos1[0]][pos1[1]].player
         other_player = 1 if player == 2 else 2
         eliminated_pieces = None
+        before = self.board[pos1[0]][pos1[1]], self.board[pos2[0]][pos2[1]]
         # if destination square has an enemy piece
         if self.board[pos2[0]][pos2[1]]:
-            if self.board[pos2[0]][pos2[1]].rank in beaten_by[self.board[pos1[0]][pos1[1]].rank]:
+            outcome = DUEL[self.board[pos1[0]][pos1[1]].rank.value][self.board[pos2[0]][pos2[1]].rank.value]
+            if outcome == WIN:
                 if self.board[pos2[0]][pos2[1]].rank == Rank.FLAG:
                     self.victor = player
                 eliminated_pieces = self.board[pos2[0]][pos2[1]],
                 self.board[pos2[0]][pos2[1]] = self.board[pos1[0]][pos1[1]]
                 self.board[pos1[0]][pos1[1]] = None
-            elif self.board[pos1[0]][pos1[1]].rank == self.board[pos2[0]][pos2[1]].rank:
+            elif outcome == DRAW:
                 eliminated_pieces = self.board[pos1[0]][pos1[1]], self.board[pos2[0]][pos2[1]]
                 self.board[pos2[0]][pos2[1]] = None
                 self.board[pos1[0]][pos1[1]] = None
@@ -94,21 +131,132 @@ class BoardManager:
                     self.victor = player
                 else:
                     self._winning[player] = True
+                    self.hash ^= zobrist.WINNING_KEYS[player]
+                    self.mirror_hash ^= zobrist.WINNING_KEYS[player]
         if self._winning[other_player] and not self.victor:
             self.victor = other_player
+        self._update_hash(pos1, before[0])
+        self._update_hash(pos2, before[1])
         return eliminated_pieces
 
 
+# stands in for the list methods that would resize or reorder a rotated board or one of its rows
+def _fixed_layout(self, *args):
+    raise TypeError('a rotated board cannot be resized or reordered')
+
+
+# a row of RotatedBoard. It is a list so that it can stand in for a row of a board, but its own list storage is
+# empty: every method reads or writes the row of the board it views, and those that would resize or reorder it fail.
+class _RotatedRow(list):
+    def __init__(self, cells):
+        super().__init__()
+        self._cells = cells
+
+    def __getitem__(self, col):
+        # plain column reads are most of the AI's reads, so they skip the general checks
+        if type(col) is int and 0 <= col < 9:
+            return self._cells[8 - col]
+        if isinstance(col, slice):
+            return self._cells[::-1][col]
+        return self._cells[self._index(col)]
+
+    def __setitem__(self, col, square):
+        self._cells[self._index(col)] = square
+
+    @staticmethod
+    def _index(col):
+        col = operator.index(col)
+        if not -9 <= col < 9:
+            raise IndexError('list index out of range')
+        return 8 - col if col >= 0 else -1 - col
+
+    def __len__(self):
+        return 9
+
+    def __iter__(self):
+        return reversed(self._cells)
+
+    def __reversed__(self):
+        return iter(self._cells)
+
+    def __contains__(self, square):
+        return square in self._cells
+
+    def copy(self):
+        return self[:]
+
+    def count(self, square):
+        return self[:].count(square)
+
+    def index(self, square, *args):
+        return self[:].index(square, *args)
+
+    def __add__(self, other):
+        return self[:] + other
+
+    def __radd__(self, other):
+        return list(other) + self[:]
+
+    def __mul__(self, n):
+        return self[:] * n
+
+    __rmul__ = __mul__
+
+    def __eq__(self, other):
+        return self[:] == other
+
+    def __ne__(self, other):
+        return self[:] != other
+
+    def __lt__(self, other):
+        return self[:] < other
+
+    def __le__(self, other):
+        return self[:] <= other
+
+    def __gt__(self, other):
+        return self[:] > other
+
+    def __ge__(self, other):
+        return self[:] >= other
+
+    def __repr__(self):
+        return repr(self[:])
+
+    append = extend = insert = pop = remove = clear = sort = reverse = __delitem__ = __iadd__ = __imul__ = \
+        _fixed_layout
+
+    # pickles and copies as a snapshot
+    def __reduce__(self):
+        return list, (self[:],)
+
+
+# the board as the other player sees it: square (r, c) of the view is square (7 - r, 8 - c) of the board, read and
+# written on access, so both players share one board and every move is only applied once. The rows of the board
+# must be updated in place rather than replaced, and the rows of the view cannot be replaced either.
+class RotatedBoard(list):
+    def __init__(self, board):
+        super().__init__(_RotatedRow(row) for row in board[::-1])
+
+    append = extend = insert = pop = remove = clear = sort = reverse = __setitem__ = __delitem__ = __iadd__ = \
+        __imul__ = _fixed_layout
+
+    def __reduce__(self):
+        return list, ([row[:] for row in self],)
+
+
 class GOG:
     def __init__(self):
         self.board = [[None] * 9 for _ in range(8)]
         self._board_manager = None
-        self.inv_board = [[None] * 9 for _ in range(8)]
-        self._inv_board_manager = None
+        self.inv_board = RotatedBoard(self.board)
         self.victor = 0
         self._initialized = {1: False, 2: False}
         self._started = False
         self.current_turn = 1
+        # what a game record needs: the formations as given to set_player_pieces and every move on self.board
+        self.formations = {1: None, 2: None}
+        self.history = []
 
     def set_player_pieces(self, pieces, player):
         def is_valid_initial_position():
@@ -127,32 +275,30 @@ class GOG:
         assert player == 1 or player == 2
         assert not self._initialized[player]
         assert is_valid_initial_position()
-        game_pieces = [[Piece(rank, player) if rank is not None else None for rank in row] for row in pieces]
-        game_pieces_inverse = [x[::-1] for x in game_pieces[::-1]]
+        self.formations[player] = [row[:] for row in pieces]
+        piece_ids = iter(range(first_piece_id(player), first_piece_id(player) + PIECES_PER_PLAYER))
+        game_pieces = [[Piece(rank, player, next(piece_ids)) if rank is not None else None for rank in row]
+                       for row in pieces]
         if player == 1:
-            self.board[0:3] = game_pieces
-            self.inv_board[5:8] = game_pieces_inverse
+            for i in range(3):
+                self.board[i][:] = game_pieces[i]
         else:
-            self.inv_board[0:3] = game_pieces
-            self.board[5:8] = game_pieces_inverse
+            for i in range(3):
+                self.board[7 - i][:] = game_pieces[i][::-1]
         self._initialized[player] = True
         if self._initialized[1] and self._initialized[2]:
             self._started = True
             self._board_manager = BoardManager(self.board)
-            self._inv_board_manager = BoardManager(self.inv_board)
         return self.board if player == 1 else self.inv_board
 
     def move(self, pos1, pos2, player):
         assert self._started
 
+        # ADJACENT only has positions on the board, so one lookup checks both squares and that they touch
         def is_valid_move(p1, p2):
-            def is_within_board(row, col):
-                return 0 <= row < 8 and 0 <= col < 9
-
-            return is_within_board(p1[0], p1[1]) and is_within_board(p2[0], p2[1]) \
+            return p2 in ADJACENT.get(p1, ()) \
                    and self.board[p1[0]][p1[1]] is not None \
                    and self.board[p1[0]][p1[1]].player == self.current_turn \
-                   and abs(p2[0] - p1[0]) + abs(p2[1] - p1[1]) == 1 \
                    and (self.board[p2[0]][p2[1]] is None
                         or self.board[p2[0]][p2[1]].player != self.board[p1[0]][p1[1]].player)
 
@@ -165,7 +311,7 @@ class GOG:
             return None
 
         eliminated_pieces = self._board_manager.move(original_move)
-        self._inv_board_manager.move(inverted_move)
+        self.history.append((original_move, eliminated_pieces))
 
         self.victor = self._board_manager.get_victor()
 
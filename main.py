@@ -1,13 +1,14 @@
 from gog import GOG
 from ai import AISmart
-from game import Game
+from worker import AIWorker
 
 
 def main():
+    from game import Game  # pygame is only loaded when a window is shown
     restart = True
     while restart:
         gog = GOG()
-        ai = AISmart(2)
+        ai = AIWorker(AISmart, 2)
         game = Game(gog, ai)
         restart = game.start()
 
@@ -53,3 +53,16 @@ for rank in Rank:
         beats[rank] = {Rank.PRIVATE}
     else:
         beats[rank] = get_beats_regular(rank)
+
+
+WIN, DRAW, LOSS = 1, 0, -1
+
+# DUEL[a][d] is the outcome for a piece of rank value a that challenges a piece of rank value d
+DUEL = [[WIN if Rank(d) in beaten_by[Rank(a)] else DRAW if a == d else LOSS for d in range(len(Rank))]
+        for a in range(len(Rank))]
+# DUEL_MASKS[a][outcome] has a bit for every rank value d with DUEL[a][d] == outcome, and
+# CHALLENGER_MASKS[d][outcome] a bit for every rank value a with DUEL[a][d] == outcome
+DUEL_MASKS = [{outcome: sum(1 << d for d in range(len(Rank)) if DUEL[a][d] == outcome) for outcome in (WIN, DRAW, LOSS)}
+              for a in range(len(Rank))]
+CHALLENGER_MASKS = [{outcome: sum(1 << a for a in range(len(Rank)) if DUEL[a][d] == outcome)
+                     for outcome in (WIN, DRAW, LOSS)} for d in range(len(Rank))]
@@ -0,0 +1,125 @@
+import struct
+import sys
+from array import array
+from itertools import islice
+
+from rank import Rank
+import compact
+from compact import CompactBoardManager
+from topology import DIRECTIONS, STEPS, square_index
+
+# a record file is MAGIC followed by games, each one a header (number of moves, victor), both formations packed
+# four bits per square (27 bytes) and two bytes per move
+MAGIC = b'GOGR\x01'
+_HEADER = struct.Struct('<IB')
+_FORMATIONS_SIZE = 27
+_EMPTY = 0xf
+
+NO_CHALLENGE, MOVER_WON, DRAW, MOVER_LOST = range(4)
+
+
+# a move is packed as its source square (7 bits), direction (2 bits) and challenge outcome (2 bits)
+def encode_move(move, outcome):
+    (r1, c1), (r2, c2) = move
+    return square_index((r1, c1)) | DIRECTIONS.index((r2 - r1, c2 - c1)) << 7 | outcome << 9
+
+
+def decode_move(code):
+    src = code & 0x7f
+    return src, src + STEPS[code >> 7 & 3], code >> 9
+
+
+# the outcome of a move from the mover's side, given the pieces it eliminated
+def move_outcome(eliminated_pieces, mover):
+    if not eliminated_pieces:
+        return NO_CHALLENGE
+    if len(eliminated_pieces) == 2:
+        return DRAW
+    return MOVER_LOST if eliminated_pieces[0].player == mover else MOVER_WON
+
+
+def _pack_formations(formations):
+    nibbles = [_EMPTY if rank is None else rank.value for player in [1, 2] for row in formations[player]
+               for rank in row]
+    return bytes(nibbles[i] | nibbles[i + 1] << 4 for i in range(0, len(nibbles), 2))
+
+
+def _unpack_formations(data):
+    nibbles = []
+    for byte in data:
+        nibbles += [byte & 0xf, byte >> 4]
+    ranks = [None if x == _EMPTY else Rank(x) for x in nibbles]
+    return {player: [ranks[27 * (player - 1) + 9 * i: 27 * (player - 1) + 9 * (i + 1)] for i in range(3)]
+            for player in [1, 2]}
+
+
+class GameRecord:
+    # formations as given to GOG.set_player_pieces, moves as packed by encode_move on player 1's board
+    def __init__(self, formations, moves, victor):
+        self.formations = formations
+        self.moves = moves
+        self.victor = victor
+
+    @classmethod
+    def from_gog(cls, gog):
+        moves = array('H')
+        # player 1 always moves first and the turns alternate
+        for ply, (move, eliminated_pieces) in enumerate(gog.history):
+            moves.append(encode_move(move, move_outcome(eliminated_pieces, 1 + ply % 2)))
+        return cls(gog.formations, moves, gog.victor)
+
+    def __len__(self):
+        return len(self.moves)
+
+    # yields the squares after every move. The same bytearray is updated in place, so copy it to keep a position.
+    def positions(self):
+        squares = compact.initial_squares(self.formations)
+        for code in self.moves:
+            src, dst, outcome = decode_move(code)
+            # the outcome is recorded, so nothing is validated or resolved again
+            if outcome == NO_CHALLENGE or outcome == MOVER_WON:
+                squares[dst] = squares[src]
+            elif outcome == DRAW:
+                squares[dst] = 0
+            squares[src] = 0
+            yield squares
+
+    # the position after plies moves, or at the end of the game
+    def replay(self, plies=None):
+        squares = compact.initial_squares(self.formations)
+        for squares in islice(self.positions(), plies):
+            pass
+        victor = self.victor if plies is None or plies >= len(self.moves) else 0
+        return CompactBoardManager(squares[:], victor)
+
+
+class RecordWriter:
+    def __init__(self, f):
+        self._f = f
+        f.write(MAGIC)
+
+    def write(self, record):
+        self._f.write(_HEADER.pack(len(record.moves), record.victor))
+        self._f.write(_pack_formations(record.formations))
+        moves = record.moves
+        if sys.byteorder == 'big':
+            moves = array('H', moves)
+            moves.byteswap()
+        self._f.write(moves.tobytes())
+
+
+# yields the games of a record file one at a time
+def read_records(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a game record file')
+    while True:
+        header = f.read(_HEADER.size)
+        if not header:
+            return
+        n_moves, victor = _HEADER.unpack(header)
+        formations = _unpack_formations(f.read(_FORMATIONS_SIZE))
+        moves = array('H')
+        moves.frombytes(f.read(2 * n_moves))
+        if sys.byteorder == 'big':
+            moves.byteswap()
+        yield GameRecord(formations, moves, victor)
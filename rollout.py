@@ -0,0 +1,89 @@
+from rank import DUEL, WIN, DRAW
+from compact import PLAYER_SHIFT, RANK_MASK, FLAG
+from topology import ROWS, COLS, NEIGHBORS
+
+# A rollout policy picks the next move of a playout. choose gets the squares of a CompactBoardManager, the player
+# to move and that player's valid moves as (src, dst) square indices, and returns one of the moves. Policies are
+# sent to worker processes, so they have to be picklable.
+
+
+class RandomRollout:
+    def choose(self, squares, player, valid_moves, rng):
+        return valid_moves[rng.randint(0, len(valid_moves) - 1)]
+
+
+# Scores a few randomly drawn valid moves and plays the best of them: capturing the flag, then capturing a weaker
+# piece, then advancing the flag, then any quiet move, while attacks on stronger pieces and steps next to them come
+# last. Only a few moves are checked per ply, so a playout costs about as much as a random one. A playout runs on a
+# determinized board, so every rank in it is known to both players.
+class HeuristicRollout:
+    def __init__(self, candidates=4):
+        self.candidates = candidates
+
+    @staticmethod
+    def score(squares, player, src, dst):
+        rank = squares[src] & RANK_MASK
+        target = squares[dst]
+        if target:
+            target_rank = target & RANK_MASK
+            outcome = DUEL[rank][target_rank]
+            if outcome == WIN:
+                return 6 if target_rank == FLAG else 5
+            return 1 if outcome == DRAW else 0
+        other_player = 1 if player == 2 else 2
+        for square in NEIGHBORS[dst]:
+            code = squares[square]
+            if code >> PLAYER_SHIFT == other_player and DUEL[code & RANK_MASK][rank] == WIN:
+                return 1
+        if rank == FLAG and (dst // COLS > src // COLS if player == 1 else dst // COLS < src // COLS):
+            return 4
+        return 2
+
+    def choose(self, squares, player, valid_moves, rng):
+        best = None
+        best_score = -1
+        for _ in range(self.candidates):
+            move = valid_moves[int(rng.random() * len(valid_moves))]
+            score = self.score(squares, player, *move)
+            if score > best_score:
+                best, best_score = move, score
+        return best
+
+
+# Stops a playout after max_plies moves and, with repetition, as soon as a position comes back, which is what play
+# around a deadlock keeps doing. The cut off playout is then decided by evaluate.
+class Cutoff:
+    def __init__(self, max_plies=None, repetition=False):
+        self.max_plies = max_plies
+        self.repetition = repetition
+
+
+# every piece but the flag is worth one more than its rank value, and the flag is worth FLAG_ROW_VALUE for every row
+# it has advanced
+_PIECE_VALUES = [rank + 1 for rank in range(15)]
+FLAG_ROW_VALUE = 2
+
+
+# static evaluation of the squares from player 1's side
+def evaluate(squares):
+    score = 0
+    for index, code in enumerate(squares):
+        if code:
+            rank = code & RANK_MASK
+            if code >> PLAYER_SHIFT == 1:
+                score += FLAG_ROW_VALUE * (index // COLS) if rank == FLAG else _PIECE_VALUES[rank]
+            else:
+                score -= FLAG_ROW_VALUE * (ROWS - 1 - index // COLS) if rank == FLAG else _PIECE_VALUES[rank]
+    return score
+
+
+# the player evaluate favors, 0 if neither
+def cutoff_victor(squares):
+    score = evaluate(squares)
+    return 1 if score > 0 else 2 if score < 0 else 0
+
+
+ROLLOUT_POLICIES = {
+    'random': RandomRollout(),
+    'heuristic': HeuristicRollout(),
+}
@@ -0,0 +1,166 @@
+from collections import Counter
+from math import factorial
+
+from beliefs import ALL_RANKS, COUNTS
+
+# remaining piece counts per rank packed three bits per rank into one int
+_SHIFT = 3
+_FIELD = (1 << _SHIFT) - 1
+_FULL = sum(count << (_SHIFT * r) for r, count in enumerate(COUNTS))
+_FACTORIALS = [factorial(n) for n in range(sum(COUNTS) + 1)]
+
+
+def _multinomial(state):
+    n = 0
+    denominator = 1
+    while state:
+        count = state & _FIELD
+        n += count
+        denominator *= _FACTORIALS[count]
+        state >>= _SHIFT
+    return _FACTORIALS[n] // denominator
+
+
+def _fields(mask):
+    field = 0
+    while mask:
+        low = mask & -mask
+        field |= _FIELD << (_SHIFT * (low.bit_length() - 1))
+        mask ^= low
+    return field
+
+
+class _TooManyStates(Exception):
+    pass
+
+
+# draws complete rank assignments for the enemy pieces uniformly among all assignments that agree with the
+# candidate rank masks and use every rank exactly as many times as player_pieces allows. Counting the assignments
+# can take hundreds of milliseconds late in a game, so it stops after max_states states and the sampler then draws
+# every piece's rank in turn from the ranks left, starting over on a dead end, which is fast but only close to
+# uniform.
+class DeterminizationSampler:
+    max_states = 200
+
+    def __init__(self, masks):
+        assert len(masks) <= sum(COUNTS)
+        # pieces that were never seen (or were never tracked) can be anything
+        masks = list(masks) + [ALL_RANKS] * (sum(COUNTS) - len(masks))
+        self._n_pieces = len(masks)
+        # the largest group of pieces sharing one mask is interchangeable, so it is left for last and filled by a
+        # shuffle of whatever ranks remain; the other pieces are walked narrowest mask first
+        tail_mask = Counter(masks).most_common(1)[0][0]
+        self._tail = [i for i in range(len(masks)) if masks[i] == tail_mask]
+        self._outside_tail = ((1 << (_SHIFT * len(COUNTS))) - 1) & ~_fields(tail_mask)
+        self._constrained = sorted(((i, masks[i]) for i in range(len(masks)) if masks[i] != tail_mask),
+                                   key=lambda x: x[1].bit_count())
+        self._memo = {}
+        try:
+            self._total = self._count(0, _FULL, self.max_states)
+            self.exact = True
+        except _TooManyStates:
+            self._memo = {}
+            self._total = None
+            self.exact = False
+
+    # the memo is rebuilt as needed, so it is not sent along to worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_memo'] = {}
+        return state
+
+    # the number of assignments, which is counted in full if the sampler is not exact
+    @property
+    def total(self):
+        if self._total is None:
+            self._total = self._count(0, _FULL)
+            self._memo = {}
+        return self._total
+
+    def _count(self, depth, state, max_states=None):
+        if depth == len(self._constrained):
+            return 0 if state & self._outside_tail else _multinomial(state)
+        key = depth, state
+        count = self._memo.get(key)
+        if count is not None:
+            return count
+        count = 0
+        mask = self._constrained[depth][1]
+        while mask:
+            low = mask & -mask
+            shift = _SHIFT * (low.bit_length() - 1)
+            if state >> shift & _FIELD:
+                count += self._count(depth + 1, state - (1 << shift), max_states)
+            mask ^= low
+        self._memo[key] = count
+        if max_states is not None and len(self._memo) > max_states:
+            raise _TooManyStates
+        return count
+
+    # returns the rank value of every piece id
+    def sample(self, rng):
+        if self.exact:
+            assert self._total, 'no rank assignment agrees with the beliefs'
+            ranks, state = self._sample_exact(rng)
+        else:
+            ranks, state = self._sample_sequential(rng)
+        remaining = []
+        r = 0
+        while state:
+            remaining += [r] * (state & _FIELD)
+            state >>= _SHIFT
+            r += 1
+        rng.shuffle(remaining)
+        for piece, rank in zip(self._tail, remaining):
+            ranks[piece] = rank
+        return ranks
+
+    def _sample_exact(self, rng):
+        ranks = [0] * self._n_pieces
+        state = _FULL
+        for depth, (piece, mask) in enumerate(self._constrained):
+            x = rng.randrange(self._count(depth, state))
+            while mask:
+                low = mask & -mask
+                shift = _SHIFT * (low.bit_length() - 1)
+                if state >> shift & _FIELD:
+                    x -= self._count(depth + 1, state - (1 << shift))
+                    if x < 0:
+                        ranks[piece] = low.bit_length() - 1
+                        state -= 1 << shift
+                        break
+                mask ^= low
+        return ranks, state
+
+    # every piece, narrowest mask first, takes one of its candidate ranks with a chance in proportion to the pieces
+    # of that rank left, as if drawn from a bag
+    def _sample_sequential(self, rng):
+        for _ in range(100):
+            ranks = [0] * self._n_pieces
+            state = _FULL
+            for piece, mask in self._constrained:
+                options = []
+                left = 0
+                while mask:
+                    low = mask & -mask
+                    shift = _SHIFT * (low.bit_length() - 1)
+                    left += state >> shift & _FIELD
+                    options.append((left, shift))
+                    mask ^= low
+                if not left:
+                    break
+                x = rng.randrange(left)
+                shift = next(shift for bound, shift in options if x < bound)
+                ranks[piece] = shift // _SHIFT
+                state -= 1 << shift
+            else:
+                if not state & self._outside_tail:
+                    return ranks, state
+        # too many dead ends, so the assignments are counted after all
+        self.exact = True
+        self._total = self._count(0, _FULL)
+        assert self._total, 'no rank assignment agrees with the beliefs'
+        return self._sample_exact(rng)
+
+    def sample_batch(self, k, rng):
+        return [self.sample(rng) for _ in range(k)]
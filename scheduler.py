@@ -0,0 +1,162 @@
+import queue
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from random import getrandbits
+from threading import Thread
+
+import numpy as np
+
+from ai import _determinization_inputs, _generate_valid_moves, _sample_board_configuration, _within_budget
+from batch import BatchSimulator
+
+
+class _Request:
+    # the board and beliefs are copied when the request is made, so the AI can go on with its game state while it
+    # waits. Preparing the search from them can take a while, so it is left to the scheduler's thread.
+    def __init__(self, pov, player, masks, playouts, deadline, occupied):
+        self.pov = [row[:] for row in pov]
+        self.masks = tuple(masks)
+        self.occupied = None if occupied is None else list(occupied)
+        self.player = player
+        self.enemy = 1 if player == 2 else 2
+        self.playouts = playouts
+        self.deadline = deadline
+        self.simulations = 0
+        self.winning_moves = defaultdict(int)
+        self.future = Future()
+
+    def prepare(self):
+        self.own_pieces_board, self.enemy_pieces, self.sampler = _determinization_inputs(self.pov, self.player,
+                                                                                         self.masks)
+        self.moves = _generate_valid_moves(self.pov, self.player, self.occupied)
+
+    def round_size(self, batch_size):
+        return batch_size if self.playouts is None else min(batch_size, self.playouts - self.simulations)
+
+
+# runs in worker processes too; plays out the boards and returns their victors and which ones expired
+def _simulate(board, turn, winning, victor, deadline, seed, max_plies=None):
+    simulator = BatchSimulator(board, turn, winning)
+    simulator.victor[:] = victor
+    simulator.finished[:] = victor != 0
+    simulator.run(np.random.default_rng(seed), max_plies, deadline)
+    return simulator.victor, simulator.expired
+
+
+# Batches the flat Monte Carlo searches of many AIs. Requests made while a round is played wait for the next one,
+# and every round plays the pending requests' playouts as one batch of about batch_size boards, split over the worker
+# processes. The boards of a request stop at its own deadline, and a request is answered once it has its playouts or
+# its deadline passes.
+class MoveScheduler:
+    def __init__(self, workers=1, executor=None, batch_size=256, max_plies=None):
+        self._workers = workers
+        self._owns_executor = executor is None and workers > 1
+        self._executor = ProcessPoolExecutor(workers) if self._owns_executor else executor
+        self.batch_size = batch_size
+        self.max_plies = max_plies
+        self.rounds = 0
+        self.simulations = 0
+        self._requests = queue.Queue()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # returns a Future of the move. occupied are the squares of player's pieces if the caller keeps them.
+    def submit(self, pov, player, masks, playouts=None, deadline=None, occupied=None):
+        assert playouts is not None or deadline is not None
+        request = _Request(pov, player, masks, playouts, deadline, occupied)
+        self._requests.put(request)
+        return request.future
+
+    # requests still waiting are cancelled
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+        if self._owns_executor:
+            self._executor.shutdown(cancel_futures=True)
+
+    def _run(self):
+        pending = []
+        while True:
+            try:
+                # waits for a request only when there is nothing to play
+                request = self._requests.get(block=not pending)
+                while True:
+                    if request is None:
+                        for request in pending:
+                            request.future.cancel()
+                        return
+                    self._prepare(request, pending)
+                    request = self._requests.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self._play_round(pending)
+            except Exception as e:
+                for request in pending:
+                    request.future.set_exception(e)
+                pending = []
+            for request in pending:
+                if not _within_budget(request.simulations, request.playouts, request.deadline):
+                    winning_moves = request.winning_moves
+                    request.future.set_result(max(winning_moves.items(), key=lambda x: x[1])[0] if winning_moves
+                                              else random.choice(request.moves))
+            pending = [request for request in pending if not request.future.done()]
+
+    @staticmethod
+    def _prepare(request, pending):
+        try:
+            request.prepare()
+        except Exception as e:
+            request.future.set_exception(e)
+            return
+        if request.moves:
+            pending.append(request)
+        else:
+            request.future.set_result(None)
+
+    def _play_round(self, requests):
+        board_managers = []
+        root_moves = []
+        owners = []
+        # The pending requests share the batch and take turns drawing their boards. Drawing takes a while too, so a
+        # request stops drawing halfway to its deadline to leave time to play them, as in AISmart._get_batch_move.
+        share = max(1, self.batch_size // len(requests))
+        now = time.time()
+        drawing = [(request, request.round_size(share),
+                    None if request.deadline is None else now + (request.deadline - now) / 2) for request in requests]
+        while drawing:
+            still_drawing = []
+            for request, size, draw_until in drawing:
+                if size <= 0 or draw_until is not None and time.time() >= draw_until:
+                    continue
+                root_moves.append(request.moves[random.randint(0, len(request.moves) - 1)])
+                board_managers.append(_sample_board_configuration(request.own_pieces_board, request.enemy_pieces,
+                                                                  request.sampler, request.enemy, random))
+                board_managers[-1].move(root_moves[-1])
+                owners.append(request)
+                still_drawing.append((request, size - 1, draw_until))
+            drawing = still_drawing
+        if not board_managers:
+            return
+        # the root move was the requester's, so every board goes on with the enemy's turn
+        simulator = BatchSimulator.from_compact(board_managers, 1)
+        simulator.turn[:] = [request.enemy for request in owners]
+        deadline = np.array([np.inf if request.deadline is None else request.deadline for request in owners])
+        slices = np.array_split(np.arange(len(owners)), self._workers if self._executor is not None else 1)
+        jobs = [(simulator.board[games], simulator.turn[games], simulator.winning[games], simulator.victor[games],
+                 deadline[games], getrandbits(64), self.max_plies) for games in slices if len(games)]
+        if self._executor is not None and len(jobs) > 1:
+            results = [future.result() for future in [self._executor.submit(_simulate, *job) for job in jobs]]
+        else:
+            results = [_simulate(*job) for job in jobs]
+        victor = np.concatenate([result[0] for result in results]).tolist()
+        expired = np.concatenate([result[1] for result in results]).tolist()
+        for request, move, v, e in zip(owners, root_moves, victor, expired):
+            if not e:
+                request.simulations += 1
+                if v == request.player:
+                    request.winning_moves[move] += 1
+        self.rounds += 1
+        self.simulations += len(owners) - sum(expired)
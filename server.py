@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import itertools
+import json
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import book
+from ai import generate_random_init_form
+from arena import ENGINES, make_ai
+from gog import GOG, player_pieces
+from record import move_outcome, NO_CHALLENGE, MOVER_WON, DRAW, MOVER_LOST
+
+# The server speaks JSON over TCP, one message per line. A connection can play any number of games against the AI
+# at once, and every message after new_game names its game:
+#   {"type": "new_game", "engine": "monte_carlo", "player": 1, "formation": "<27 characters as in book.py>"}
+#   {"type": "move", "game": 1, "from": [2, 0], "to": [3, 0]}
+#   {"type": "close", "game": 1}
+# new_game is answered with {"type": "started", "game", "player", "board"}, and every move of either side is pushed
+# as {"type": "event", "game", "player", "move", "outcome", "victor"}, where outcome is from the mover's side.
+# Positions are on the client's side of the board, which shows the ranks of the client's own pieces and '?' for
+# the enemy's. Anything that cannot be done is answered with {"type": "error", "game", "message"}.
+OUTCOMES = {NO_CHALLENGE: 'none', MOVER_WON: 'won', DRAW: 'draw', MOVER_LOST: 'lost'}
+
+
+def _board(view, player):
+    return [[None if x is None else x.rank.name if x.player == player else '?' for x in row] for row in view]
+
+
+def _formation(text):
+    if not isinstance(text, str) or len(text) != 27:
+        raise ValueError('a formation is 27 characters')
+    formation = book.parse_formation(text)
+    if Counter(rank for row in formation for rank in row if rank is not None) != player_pieces:
+        raise ValueError('the formation does not have every piece')
+    return formation
+
+
+def _position(value):
+    if not isinstance(value, list) or len(value) != 2 or not all(type(x) is int for x in value):
+        raise ValueError('a position is [row, column]')
+    return tuple(value)
+
+
+class Match:
+    def __init__(self, game_id, player, ai, send):
+        self.id = game_id
+        self.player = player
+        self.ai_player = 1 if player == 2 else 2
+        self.gog = GOG()
+        self.ai = ai
+        self.closed = False
+        self._send = send
+        self._thinking = None
+
+    def start(self, formation):
+        view = self.gog.set_player_pieces(formation, self.player)
+        self.ai.set_pov(self.gog.set_player_pieces(self.ai.get_init_form(), self.ai_player))
+        self.ai.enemy_set_pieces()
+        self._send({'type': 'started', 'game': self.id, 'player': self.player, 'board': _board(view, self.player)})
+
+    @property
+    def thinking(self):
+        return self._thinking is not None and not self._thinking.done()
+
+    def _played(self, event, mover):
+        self.ai.board_event((event[0][self.ai_player], event[1]))
+        move = event[0][self.player]
+        self._send({'type': 'event', 'game': self.id, 'player': mover, 'move': [list(move[0]), list(move[1])],
+                    'outcome': OUTCOMES[move_outcome(event[1], mover)], 'victor': self.gog.victor})
+
+    # returns an error message if the move cannot be played
+    def move(self, src, dst):
+        if self.gog.victor:
+            return 'the game is over'
+        if self.gog.current_turn != self.player or self.thinking:
+            return 'not your turn'
+        event = self.gog.move(src, dst, self.player)
+        if not event:
+            return 'invalid move'
+        self._played(event, self.player)
+        return None
+
+    def think(self, executor):
+        if not self.closed and not self.gog.victor and self.gog.current_turn == self.ai_player:
+            self._thinking = asyncio.ensure_future(self._ai_turn(executor))
+
+    # the search runs on the executor, or on the scheduler of a batch engine; the board is only touched from the
+    # event loop. A search that fails is reported to the client like a move the AI does not have.
+    async def _ai_turn(self, executor):
+        try:
+            if getattr(self.ai, 'scheduler', None) is not None:
+                move = await asyncio.wrap_future(self.ai.submit_move())
+            else:
+                move = await asyncio.get_running_loop().run_in_executor(executor, self.ai.get_move)
+            if self.closed:
+                return
+            if move is None:
+                self._send({'type': 'error', 'game': self.id, 'message': 'the AI has no move'})
+                return
+            self._played(self.gog.move(move[0], move[1], self.ai_player), self.ai_player)
+        except Exception as e:
+            if not self.closed:
+                self._send({'type': 'error', 'game': self.id, 'message': f'the AI failed: {e}'})
+        finally:
+            if self.closed:
+                self._close_ai()
+
+    # a search in flight is left to finish, and the AI is closed after it
+    def close(self):
+        self.closed = True
+        if not self.thinking:
+            self._close_ai()
+
+    def _close_ai(self):
+        if hasattr(self.ai, 'close'):
+            self.ai.close()
+
+
+# Hosts the matches of every connection in one process. The AI searches of all of them run on one pool of threads,
+# and with workers > 1 the monte_carlo playouts also share one pool of processes, so neither grows with the number
+# of games. With batch, every game is played by the batch engine, and the searches of all of them are played
+# together by one MoveScheduler.
+class GameServer:
+    def __init__(self, engine='monte_carlo', threads=4, workers=1, time_limit=None, batch=False):
+        if batch and engine != 'batch':
+            raise ValueError('only the batch engine can be batched')
+        self.engine = engine
+        self.time_limit = time_limit
+        self._workers = workers
+        self._threads = ThreadPoolExecutor(threads)
+        self._processes = ProcessPoolExecutor(workers) if workers > 1 else None
+        self._scheduler = None
+        if batch:
+            from scheduler import MoveScheduler  # numpy is only needed for batching
+            self._scheduler = MoveScheduler(workers, self._processes)
+        self._game_ids = itertools.count(1)
+        self._server = None
+        # the handler task of every open connection by its writer
+        self._connections = {}
+        self.matches = {}
+
+    # returns the port, which the system picks if port is 0
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        # closing a connection ends its handler, which closes its matches
+        for writer in self._connections:
+            writer.close()
+        await asyncio.gather(*self._connections.values(), return_exceptions=True)
+        for match in list(self.matches.values()):
+            match.close()
+        self._threads.shutdown(cancel_futures=True)
+        if self._scheduler is not None:
+            self._scheduler.close()
+        if self._processes is not None:
+            self._processes.shutdown(cancel_futures=True)
+
+    async def _serve(self, reader, writer):
+        def send(message):
+            if not writer.is_closing():
+                writer.write(json.dumps(message).encode() + b'\n')
+
+        own_matches = {}
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while line := await reader.readline():
+                message = None
+                try:
+                    message = json.loads(line)
+                    error = self._handle(message, own_matches, send)
+                except KeyError as e:
+                    error = f'missing {e}'
+                except (ValueError, TypeError) as e:
+                    error = str(e)
+                if error:
+                    send({'type': 'error', 'game': message.get('game') if isinstance(message, dict) else None,
+                          'message': error})
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            del self._connections[writer]
+            for match in own_matches.values():
+                match.close()
+                del self.matches[match.id]
+            writer.close()
+
+    # returns an error message if the request cannot be done
+    def _handle(self, message, own_matches, send):
+        if message['type'] == 'new_game':
+            engine = message.get('engine', self.engine)
+            if engine not in ENGINES:
+                return f'unknown engine {engine}'
+            if self._scheduler is not None and engine != 'batch':
+                return 'the server only plays the batch engine'
+            player = message.get('player', 1)
+            if player not in (1, 2):
+                return 'player is 1 or 2'
+            formation = _formation(message['formation']) if 'formation' in message else \
+                book.sample_formation() or generate_random_init_form()
+            ai = make_ai(engine, 1 if player == 2 else 2, self.time_limit, self._processes, self._workers,
+                         self._scheduler)
+            match = Match(next(self._game_ids), player, ai, send)
+            own_matches[match.id] = self.matches[match.id] = match
+            match.start(formation)
+            match.think(self._threads)
+            return None
+        match = own_matches.get(message['game'])
+        if match is None:
+            return 'no such game'
+        if message['type'] == 'move':
+            error = match.move(_position(message['from']), _position(message['to']))
+            if not error:
+                match.think(self._threads)
+            return error
+        if message['type'] == 'close':
+            match.close()
+            del own_matches[match.id], self.matches[match.id]
+            return None
+        return f'unknown message type {message["type"]}'
+
+
+async def _main(args):
+    server = GameServer(args.engine or ('batch' if args.batch else 'monte_carlo'), args.threads, args.workers,
+                        args.time_limit, args.batch)
+    port = await server.start(args.host, args.port)
+    print(json.dumps({'host': args.host, 'port': port}), flush=True)
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Game server for many concurrent games against the AI.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--engine', choices=ENGINES,
+                        help='engine of games that name none, monte_carlo by default or batch with --batch')
+    parser.add_argument('--threads', type=int, default=4, help='AI searches run at the same time')
+    parser.add_argument('--workers', type=int, default=1, help='processes shared by the monte_carlo playouts')
+    parser.add_argument('--time-limit', type=float, help='seconds per AI move instead of a number of playouts')
+    parser.add_argument('--batch', action='store_true',
+                        help='play every game with the batch engine and its searches in shared batches')
+    args = parser.parse_args()
+    if args.batch and args.engine not in (None, 'batch'):
+        parser.error('--batch plays only the batch engine')
+    asyncio.run(_main(args))
@@ -1,6 +1,40 @@
+import asyncio
+import json
+import pickle
+import subprocess
+import sys
+import time
 import unittest
-from gog import GOG
-from rank import Rank
+from random import Random
+from unittest import mock
+from gog import GOG, BoardManager, Piece, player_pieces, PIECES_PER_PLAYER, first_piece_id
+from rank import Rank, beaten_by, DUEL, WIN, DRAW, LOSS, DUEL_MASKS, CHALLENGER_MASKS
+from compact import CompactBoardManager, generate_valid_moves, square_pos, square_index
+from ai import AIRandom, AISmart, _generate_valid_moves, _occupied_squares, generate_random_init_form, _playout
+from concurrent.futures import ProcessPoolExecutor
+import arena
+import bench
+from beliefs import Beliefs, rank_mask, MASK_WEIGHTS, ALL_RANKS
+from sampler import DeterminizationSampler
+from collections import Counter
+from queue import Queue
+from worker import AIWorker
+from zobrist import TranspositionTable, mirror_square
+import topology
+from io import BytesIO
+from record import GameRecord, RecordWriter, read_records
+from rollout import ROLLOUT_POLICIES, HeuristicRollout, Cutoff, evaluate
+import book
+import formation
+from server import GameServer
+import os
+import tempfile
+
+try:
+    import numpy as np
+    import batch
+except ImportError:
+    batch = None
 
 FLG, PRVT, SRGNT, SND_LT, FST_LT, CPTN, MJR, LT_CLNL, CLNL, G_ONE, G_TWO, G_THREE, G_FOUR, G_FIVE, SPY = Rank
 
@@ -323,5 +357,823 @@ class GameTest(unittest.TestCase):
         self.pov = None
 
 
+class RotatedBoardTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.gog = GOG()
+        self.gog.set_player_pieces(initial_pos_one, 1)
+        self.view = self.gog.set_player_pieces(initial_pos_two, 2)
+
+    def _assert_rotated(self):
+        for i in range(8):
+            for j in range(9):
+                self.assertIs(self.view[i][j], self.gog.board[7 - i][8 - j])
+            self.assertListEqual(self.view[i], self.gog.board[7 - i][::-1])
+
+    def test_view_follows_moves(self):
+        self._assert_rotated()
+        self.gog.move((2, 0), (3, 0), 1)
+        self.gog.move((2, 1), (3, 1), 2)
+        self._assert_rotated()
+        self.assertIsNone(self.view[2][1])
+        self.assertIsNotNone(self.view[3][1])
+
+    def test_snapshot(self):
+        snapshot = pickle.loads(pickle.dumps(self.view))
+        self.assertIs(type(snapshot[0]), list)
+        self.assertEqual(board_ranks(snapshot), board_ranks(self.view))
+        self.assertListEqual([row[:] for row in self.view[5:8]], [row[::-1] for row in self.gog.board[2::-1]])
+
+    def test_list_methods(self):
+        row = self.view[5]
+        expected = self.gog.board[2][::-1]
+        piece = expected[2]
+        self.assertListEqual(row.copy(), expected)
+        self.assertEqual((row.count(piece), row.index(piece)), (expected.count(piece), expected.index(piece)))
+        self.assertListEqual(row + [1], expected + [1])
+        self.assertListEqual([1] + row, [1] + expected)
+        self.assertListEqual(row * 2, expected * 2)
+        with self.assertRaises(IndexError):
+            row[9]
+        with self.assertRaises(IndexError):
+            row[-10] = None
+        for resize in (lambda: row.append(None), lambda: row.pop(), lambda: row.sort(key=id),
+                       lambda: self.view.append(row), lambda: self.view.__setitem__(0, [])):
+            with self.assertRaises(TypeError):
+                resize()
+        self._assert_rotated()
+
+    def tearDown(self) -> None:
+        self.gog = None
+        self.view = None
+
+
+class PieceIdTest(unittest.TestCase):
+    def test_ids(self):
+        gog = GOG()
+        gog.set_player_pieces(initial_pos_one, 1)
+        view = gog.set_player_pieces(initial_pos_two, 2)
+        pieces = [x for row in gog.board for x in row if x]
+        self.assertListEqual(sorted(x.id for x in pieces), list(range(2 * PIECES_PER_PLAYER)))
+        for player in [1, 2]:
+            ids = [x.id for x in pieces if x.player == player]
+            self.assertEqual(min(ids), first_piece_id(player))
+        # ids follow the formation as given, so both players can number the enemy pieces the same way
+        self.assertEqual(view[7][8].id, first_piece_id(1))
+        self.assertEqual(view[0][0].id, first_piece_id(2))
+        ids = {x: x.id for x in pieces}
+        gog.move((2, 0), (3, 0), 1)
+        self.assertTrue(all(x.id == i for x, i in ids.items()))
+
+    def test_slots(self):
+        piece = Piece(Rank.SPY, 2, 30)
+        self.assertFalse(hasattr(piece, '__dict__'))
+        copy = pickle.loads(pickle.dumps(piece))
+        self.assertEqual((copy.rank, copy.player, copy.id), (Rank.SPY, 2, 30))
+
+
+def initial_board():
+    board = [[None] * 9 for _ in range(8)]
+    board[0:3] = [[Piece(rank, 1) if rank else None for rank in row] for row in initial_pos_one]
+    board[5:8] = [[Piece(rank, 2) if rank else None for rank in row] for row in initial_pos_two]
+    return board
+
+
+def board_ranks(board):
+    return [[(x.rank, x.player) if x else None for x in row] for row in board]
+
+
+class TopologyTest(unittest.TestCase):
+    def test_neighbors(self):
+        self.assertEqual(Counter(len(x) for x in topology.NEIGHBORS), {2: 4, 3: 2 * (6 + 7), 4: 6 * 7})
+        for index, neighbors in enumerate(topology.NEIGHBORS):
+            row, col = square_pos(index)
+            self.assertEqual(topology.NEIGHBOR_POSITIONS[row][col], tuple(square_pos(n) for n in neighbors))
+            self.assertSetEqual(topology.ADJACENT[row, col], set(topology.NEIGHBOR_POSITIONS[row][col]))
+            for n in neighbors:
+                self.assertIn(index, topology.NEIGHBORS[n])
+                self.assertEqual(abs(square_pos(n)[0] - row) + abs(square_pos(n)[1] - col), 1)
+
+    def test_off_board(self):
+        self.assertNotIn((-1, 0), topology.ADJACENT)
+        self.assertNotIn((8, 0), topology.ADJACENT[7, 0])
+        self.assertEqual(len(topology.ADJACENT), topology.SQUARES)
+
+
+class CompactBoardTest(unittest.TestCase):
+    def test_round_trip(self):
+        board = initial_board()
+        self.assertListEqual(board_ranks(board), board_ranks(CompactBoardManager.from_board(board).to_board()))
+
+    def test_matches_board_manager(self):
+        rng = Random(7)
+        for _ in range(20):
+            board_manager = BoardManager(initial_board())
+            compact_board_manager = CompactBoardManager.from_board(board_manager.board)
+            player = 1
+            while not board_manager.get_victor():
+                valid_moves = generate_valid_moves(compact_board_manager.squares, player)
+                if not valid_moves:
+                    break
+                src, dst = valid_moves[rng.randrange(len(valid_moves))]
+                move = square_pos(src), square_pos(dst)
+                eliminated_pieces = board_manager.move(move)
+                compact_eliminated_pieces = compact_board_manager.move(move)
+                self.assertEqual(eliminated_pieces is None, compact_eliminated_pieces is None)
+                self.assertEqual(board_manager.get_victor(), compact_board_manager.get_victor())
+                self.assertListEqual(board_ranks(board_manager.board),
+                                     board_ranks(compact_board_manager.to_board()))
+                for p in [1, 2]:
+                    self.assertSetEqual({(i, j) for i, row in enumerate(board_manager.board)
+                                         for j, square in enumerate(row) if square and square.player == p},
+                                        {square_pos(idx) for idx in compact_board_manager.occupied[p]})
+                player = 2 if player == 1 else 1
+
+
+class ZobristTest(unittest.TestCase):
+    def test_incremental_hash(self):
+        rng = Random(11)
+        for _ in range(10):
+            board_manager = BoardManager(initial_board())
+            compact_board_manager = CompactBoardManager.from_board(board_manager.board)
+            player = 1
+            while not board_manager.get_victor():
+                valid_moves = generate_valid_moves(compact_board_manager.squares, player)
+                if not valid_moves:
+                    break
+                move = [square_pos(x) for x in valid_moves[rng.randrange(len(valid_moves))]]
+                board_manager.move(move)
+                compact_board_manager.move(move)
+                fresh = CompactBoardManager(compact_board_manager.squares[:],
+                                            winning=compact_board_manager._winning[:])
+                self.assertEqual(board_manager.hash, fresh.hash)
+                self.assertEqual(compact_board_manager.hash, fresh.hash)
+                self.assertEqual(compact_board_manager.mirror_hash, fresh.mirror_hash)
+                player = 2 if player == 1 else 1
+
+    def test_mirror_hash(self):
+        board_manager = CompactBoardManager.from_board(initial_board())
+        mirrored = bytearray(len(board_manager.squares))
+        for index, code in enumerate(board_manager.squares):
+            mirrored[mirror_square(index)] = code
+        mirrored = CompactBoardManager(mirrored)
+        self.assertEqual(board_manager.hash, mirrored.mirror_hash)
+        self.assertEqual(board_manager.mirror_hash, mirrored.hash)
+
+    def test_hidden_ranks_hash_the_same(self):
+        board = initial_board()
+        view = CompactBoardManager.from_board(board, view=1).hash
+        board[5][0], board[5][1] = board[5][1], board[5][0]
+        self.assertEqual(view, CompactBoardManager.from_board(board, view=1).hash)
+        self.assertNotEqual(view, CompactBoardManager.from_board(board, view=2).hash)
+
+    def test_mirrored_positions_share_an_entry(self):
+        table = TranspositionTable(4)
+        move = square_index((2, 1)), square_index((3, 1))
+        table.store(5, 3, value=1.0, best_move=move, depth=2)
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table.best_move(3, 5), (mirror_square(move[0]), mirror_square(move[1])))
+        self.assertEqual(table.best_move(5, 3), move)
+
+    def test_replacement_keeps_deeper_entries(self):
+        table = TranspositionTable(4)
+        table.store(1, depth=3)
+        self.assertIsNone(table.store(17, depth=1))
+        self.assertIsNotNone(table.probe(1)[0])
+        table.new_search()
+        self.assertIsNotNone(table.store(17, depth=1))
+        self.assertIsNone(table.probe(1)[0])
+
+
+@unittest.skipIf(batch is None, 'numpy is not installed')
+class BatchSimulatorTest(unittest.TestCase):
+    def test_matches_compact_board_manager(self):
+        rng = np.random.default_rng(3)
+        board_managers = [CompactBoardManager.from_board(initial_board()) for _ in range(50)]
+        simulator = batch.BatchSimulator.from_compact(board_managers, 1)
+        player = 1
+        while not simulator.finished.all():
+            games, src, dst = simulator.sample_moves(rng)
+            for game, s, d in zip(games.tolist(), src.tolist(), dst.tolist()):
+                self.assertIn((s, d), generate_valid_moves(board_managers[game].squares, player))
+                board_managers[game].move_squares(s, d)
+            simulator.apply_moves(games, src, dst)
+            for game, board_manager in enumerate(board_managers):
+                if game in games:
+                    self.assertEqual(bytes(board_manager.squares), simulator.board[game].tobytes())
+                    self.assertEqual(board_manager.get_victor(), simulator.victor[game])
+            player = 2 if player == 1 else 1
+
+    def test_batch_search(self):
+        gog = GOG()
+        gog.set_player_pieces(initial_pos_one, 1)
+        ai = AISmart(2, search='batch', playouts=50)
+        ai.set_pov(gog.set_player_pieces(initial_pos_two, 2))
+        ai.enemy_set_pieces()
+        self.assertIn(ai.get_move(), _generate_valid_moves(ai._pov, 2))
+        self.assertEqual(ai.simulations, 50)
+        ai.set_pov([[None if x is not None and x.player == 2 else x for x in row] for row in ai._pov])
+        self.assertIsNone(ai.get_move())
+
+    def test_deadline_per_game(self):
+        board_managers = [CompactBoardManager.from_board(initial_board()) for _ in range(4)]
+        simulator = batch.BatchSimulator.from_compact(board_managers, 1)
+        simulator.run(np.random.default_rng(4), deadline=np.array([0, np.inf, 0, np.inf]))
+        self.assertListEqual(simulator.expired.tolist(), [True, False, True, False])
+        self.assertTrue(simulator.finished.all())
+        self.assertListEqual(simulator.victor[[0, 2]].tolist(), [0, 0])
+
+
+@unittest.skipIf(batch is None, 'numpy is not installed')
+class MoveSchedulerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        from scheduler import MoveScheduler
+        self.scheduler = MoveScheduler()
+
+    def _ai(self, **kwargs):
+        gog = GOG()
+        gog.set_player_pieces(initial_pos_one, 1)
+        ai = AISmart(2, search='batch', scheduler=self.scheduler, **kwargs)
+        ai.set_pov(gog.set_player_pieces(initial_pos_two, 2))
+        ai.enemy_set_pieces()
+        return ai
+
+    def test_requests_share_rounds(self):
+        ais = [self._ai(playouts=30) for _ in range(3)]
+        futures = [ai.submit_move() for ai in ais]
+        for ai, future in zip(ais, futures):
+            self.assertIn(future.result(), _generate_valid_moves(ai._pov, 2))
+        self.assertEqual(self.scheduler.simulations, 90)
+        self.assertLessEqual(self.scheduler.rounds, 3)
+        self.assertIn(ais[0].get_move(), _generate_valid_moves(ais[0]._pov, 2))
+
+    def test_deadline(self):
+        ai = self._ai(playouts=None, time_limit=0.2)
+        start = time.time()
+        self.assertIn(ai.get_move(), _generate_valid_moves(ai._pov, 2))
+        self.assertLess(time.time() - start, 2)
+
+    def test_many_deadlines(self):
+        ais = [self._ai(playouts=None, time_limit=0.1) for _ in range(64)]
+        ais[0].get_move()
+        start = time.time()
+        futures = [ai.submit_move() for ai in ais]
+        for ai, future in zip(ais, futures):
+            self.assertIn(future.result(), _generate_valid_moves(ai._pov, 2))
+        # every request shares the round, so none waits for the boards of the others
+        self.assertLess(time.time() - start, 0.3)
+
+    def tearDown(self) -> None:
+        self.scheduler.close()
+
+
+class DuelTest(unittest.TestCase):
+    def test_table_matches_beaten_by(self):
+        for a in Rank:
+            for d in Rank:
+                expected = WIN if d in beaten_by[a] else DRAW if a == d else LOSS
+                self.assertEqual(DUEL[a.value][d.value], expected)
+        self.assertEqual(DUEL[Rank.FLAG.value][Rank.FLAG.value], WIN)
+        self.assertEqual(DUEL[Rank.PRIVATE.value][Rank.SPY.value], WIN)
+        self.assertEqual(DUEL[Rank.SPY.value][Rank.GENERAL_FIVE.value], WIN)
+
+    def test_weights(self):
+        self.assertEqual(MASK_WEIGHTS[ALL_RANKS], 21)
+        self.assertEqual(MASK_WEIGHTS[rank_mask([Rank.PRIVATE, Rank.SPY])], 8)
+        # the weights Expectiminimax gives the outcomes of a challenge
+        private = DUEL_MASKS[Rank.PRIVATE.value]
+        self.assertEqual([MASK_WEIGHTS[private[x]] for x in (WIN, DRAW, LOSS)], [3, 6, 12])
+        flag = CHALLENGER_MASKS[Rank.FLAG.value]
+        self.assertEqual([MASK_WEIGHTS[flag[x]] for x in (WIN, DRAW, LOSS)], [21, 0, 0])
+        spy = CHALLENGER_MASKS[Rank.SPY.value]
+        mask = rank_mask([Rank.PRIVATE, Rank.GENERAL_FIVE])
+        self.assertEqual([MASK_WEIGHTS[mask & spy[x]] for x in (WIN, DRAW, LOSS)], [6, 0, 1])
+
+
+class BeliefsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.beliefs = Beliefs(21)
+
+    def test_known_piece_is_removed_from_other_pieces(self):
+        self.assertTrue(self.beliefs.piece_is(0, G_FIVE))
+        self.assertSetEqual(self.beliefs.rank_set(0), {G_FIVE})
+        for piece in range(1, 21):
+            self.assertNotIn(G_FIVE, self.beliefs.rank_set(piece))
+
+    def test_count_constraint(self):
+        for piece in range(6, 21):
+            self.assertTrue(self.beliefs.exclude(piece, rank_mask([PRVT])))
+        for piece in range(6):
+            self.assertSetEqual(self.beliefs.rank_set(piece), {PRVT})
+
+    def test_contradiction(self):
+        self.assertTrue(self.beliefs.piece_is(0, G_FIVE))
+        self.assertFalse(self.beliefs.piece_is(1, G_FIVE))
+
+    def test_undo(self):
+        mark = self.beliefs.mark()
+        before = self.beliefs.copy()
+        self.beliefs.piece_is(0, G_FIVE)
+        self.beliefs.piece_is(1, G_FIVE)
+        self.beliefs.undo(mark)
+        self.assertListEqual(before.ranks, self.beliefs.ranks)
+        self.assertListEqual(before.pieces, self.beliefs.pieces)
+        self.assertTrue(self.beliefs.consistent)
+
+    def tearDown(self) -> None:
+        self.beliefs = None
+
+
+class DeterminizationSamplerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        known = [FLG] + [PRVT] * 5 + [SPY] + [SRGNT, SND_LT, FST_LT, CPTN, MJR, LT_CLNL, CLNL, G_ONE, G_TWO, G_THREE,
+                                              G_FOUR]
+        self.masks = [rank_mask([PRVT, SPY]), rank_mask([PRVT, SPY, G_FIVE]), rank_mask([PRVT, SPY, G_FIVE])] + \
+                     [rank_mask([rank]) for rank in known]
+
+    def test_total(self):
+        self.assertEqual(DeterminizationSampler(self.masks).total, 4)
+
+    def test_samples_are_consistent_and_uniform(self):
+        sampler = DeterminizationSampler(self.masks)
+        samples = Counter(tuple(x[:3]) for x in sampler.sample_batch(4000, Random(11)))
+        self.assertEqual(len(samples), 4)
+        for count in samples.values():
+            self.assertAlmostEqual(count / 4000, 0.25, delta=0.03)
+        for ranks in sampler.sample_batch(50, Random(12)):
+            for piece, rank in enumerate(ranks):
+                self.assertTrue(self.masks[piece] >> rank & 1)
+
+    def test_untracked_pieces_can_be_anything(self):
+        sampler = DeterminizationSampler([rank_mask([FLG])])
+        ranks = sampler.sample(Random(1))
+        self.assertEqual(ranks[0], FLG.value)
+        self.assertListEqual(sorted(ranks), sorted(r.value for r in Rank for _ in range(player_pieces[r])))
+
+    def test_sequential_when_counting_is_too_large(self):
+        masks = [ALL_RANKS & ~rank_mask([rank]) for rank in Rank] + [ALL_RANKS & ~rank_mask([FLG, SPY])] * 6
+        sampler = DeterminizationSampler(masks)
+        self.assertFalse(sampler.exact)
+        self.assertLessEqual(len(sampler._memo), DeterminizationSampler.max_states)
+        for ranks in sampler.sample_batch(200, Random(13)):
+            self.assertListEqual(sorted(ranks), sorted(r.value for r in Rank for _ in range(player_pieces[r])))
+            for piece, rank in enumerate(ranks):
+                self.assertTrue(masks[piece] >> rank & 1)
+
+    def test_memo_is_not_pickled(self):
+        sampler = DeterminizationSampler(self.masks)
+        copy = pickle.loads(pickle.dumps(sampler))
+        self.assertEqual(copy._memo, {})
+        self.assertEqual(copy.total, 4)
+        self.assertTrue(all(self.masks[piece] >> rank & 1 for piece, rank in enumerate(copy.sample(Random(2)))))
+
+
+class MonteCarloTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.gog = GOG()
+        self.gog.set_player_pieces(initial_pos_one, 1)
+        self.ai = AISmart(2)
+        self.ai.set_pov(self.gog.set_player_pieces(initial_pos_two, 2))
+        self.ai.enemy_set_pieces()
+
+    def test_serial_returns_valid_move(self):
+        move = self.ai.get_move()
+        self.assertIn(move, _generate_valid_moves(self.ai._pov, 2))
+
+    def test_playout_budget(self):
+        self.ai = AISmart(2, playouts=7)
+        self.ai.set_pov(self.gog.inv_board)
+        self.ai.enemy_set_pieces()
+        self.ai.get_move()
+        self.assertEqual(self.ai.simulations, 7)
+
+    def test_time_budget(self):
+        for search in ['monte_carlo', 'tree']:
+            self.ai = AISmart(2, search=search, playouts=None, time_limit=0.2)
+            self.ai.set_pov(self.gog.inv_board)
+            self.ai.enemy_set_pieces()
+            start = time.time()
+            move = self.ai.get_move()
+            self.assertLess(time.time() - start, 1)
+            self.assertIn(move, _generate_valid_moves(self.ai._pov, 2))
+            self.assertGreater(self.ai.simulations, 0)
+
+    def test_parallel_returns_valid_move(self):
+        with ProcessPoolExecutor(2) as executor:
+            monte_carlo = AISmart.MonteCarlo(self.ai._pov, 2, self.ai._beliefs.ranks, playouts=20,
+                                             executor=executor, workers=2)
+        self.assertIn(monte_carlo.get_move(), _generate_valid_moves(self.ai._pov, 2))
+
+    def test_occupied_squares_follow_the_game(self):
+        random_ais = {1: AIRandom(1), 2: AIRandom(2)}
+        random_ais[1].set_pov(self.gog.board)
+        random_ais[2].set_pov(self.gog.inv_board)
+        for _ in range(100):
+            if self.gog.victor:
+                break
+            player = self.gog.current_turn
+            move = random_ais[player].get_move()
+            event = self.gog.move(move[0], move[1], player)
+            for p, ai in [(1, random_ais[1]), (2, random_ais[2]), (2, self.ai)]:
+                ai.board_event((event[0][p], event[1]))
+                self.assertSetEqual(ai._occupied, _occupied_squares(ai._pov, p))
+
+    def test_no_moves(self):
+        self.ai.set_pov(self.gog.inv_board)
+        self.ai.enemy_set_pieces()
+        pov = [[None if x is not None and x.player == 2 else x for x in row] for row in self.ai._pov]
+        self.assertIsNone(AISmart.MonteCarlo(pov, 2, self.ai._beliefs.ranks, playouts=20).get_move())
+
+    def tearDown(self) -> None:
+        self.gog = None
+        self.ai = None
+
+
+class RolloutTest(unittest.TestCase):
+    def test_heuristic_prefers_captures(self):
+        squares = bytearray(72)
+        squares[square_index((3, 4))] = 1 << 4 | Rank.GENERAL_FIVE.value
+        squares[square_index((4, 4))] = 2 << 4 | Rank.FLAG.value
+        squares[square_index((3, 5))] = 2 << 4 | Rank.PRIVATE.value
+        squares[square_index((2, 4))] = 2 << 4 | Rank.SPY.value
+        score = HeuristicRollout.score
+        self.assertGreater(score(squares, 1, square_index((3, 4)), square_index((4, 4))),
+                           score(squares, 1, square_index((3, 4)), square_index((3, 5))))
+        self.assertGreater(score(squares, 1, square_index((3, 4)), square_index((3, 5))),
+                           score(squares, 1, square_index((3, 4)), square_index((3, 3))))
+        self.assertGreater(score(squares, 1, square_index((3, 4)), square_index((3, 3))),
+                           score(squares, 1, square_index((3, 4)), square_index((2, 4))))
+
+    def test_heuristic_search_returns_valid_move(self):
+        gog = GOG()
+        gog.set_player_pieces(initial_pos_one, 1)
+        pov = gog.set_player_pieces(initial_pos_two, 2)
+        for search in ['monte_carlo', 'tree']:
+            ai = AISmart(2, search=search, playouts=20, rollout='heuristic')
+            ai.set_pov(pov)
+            ai.enemy_set_pieces()
+            self.assertIn(ai.get_move(), _generate_valid_moves(ai._pov, 2))
+
+
+class CutoffTest(unittest.TestCase):
+    def test_evaluate(self):
+        board_manager = CompactBoardManager.from_board(initial_board())
+        self.assertEqual(evaluate(board_manager.squares), 0)
+        board_manager.squares[square_index((0, 0))] = 0
+        self.assertLess(evaluate(board_manager.squares), 0)
+
+    def test_playouts_stop_at_the_cap(self):
+        class Counting:
+            plies = 0
+
+            def choose(self, squares, player, valid_moves, rng):
+                Counting.plies += 1
+                return ROLLOUT_POLICIES['random'].choose(squares, player, valid_moves, rng)
+        rng = Random(0)
+        for _ in range(20):
+            Counting.plies = 0
+            board_manager = CompactBoardManager.from_board(initial_board())
+            self.assertIn(_playout(board_manager, 1, rng, Counting(), Cutoff(10)), [0, 1, 2])
+            self.assertLessEqual(Counting.plies, 10)
+
+    def test_repetition(self):
+        # both privates step right and back, so the first position comes back after four plies
+        class Shuttle:
+            def __init__(self):
+                self.plies = 0
+
+            def choose(self, squares, player, valid_moves, rng):
+                self.plies += 1
+                for src, dst in valid_moves:
+                    if squares[src] & 0xf == Rank.PRIVATE.value and dst - src == (1 if src % 9 % 2 == 0 else -1):
+                        return src, dst
+        squares = bytearray(72)
+        squares[square_index((3, 0))] = 1 << 4 | Rank.PRIVATE.value
+        squares[square_index((5, 0))] = 2 << 4 | Rank.PRIVATE.value
+        squares[square_index((0, 4))] = 1 << 4 | Rank.FLAG.value
+        squares[square_index((7, 4))] = 2 << 4 | Rank.FLAG.value
+        policy = Shuttle()
+        self.assertEqual(_playout(CompactBoardManager(squares[:]), 1, Random(0), policy, Cutoff(None, True)), 0)
+        self.assertEqual(policy.plies, 4)
+        policy = Shuttle()
+        self.assertEqual(_playout(CompactBoardManager(squares[:]), 1, Random(0), policy, Cutoff(50)), 0)
+        self.assertEqual(policy.plies, 50)
+
+    def test_cutoff_search_returns_valid_move(self):
+        gog = GOG()
+        gog.set_player_pieces(initial_pos_one, 1)
+        pov = gog.set_player_pieces(initial_pos_two, 2)
+        for search in ['monte_carlo', 'tree']:
+            ai = AISmart(2, search=search, playouts=20, playout_plies=30, repetition_cutoff=True)
+            ai.set_pov(pov)
+            ai.enemy_set_pieces()
+            self.assertIn(ai.get_move(), _generate_valid_moves(ai._pov, 2))
+
+
+class TreeSearchTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.gog = GOG()
+        self.gog.set_player_pieces(initial_pos_one, 1)
+        self.ai = AISmart(2, search='tree')
+        self.ai.set_pov(self.gog.set_player_pieces(initial_pos_two, 2))
+        self.ai.enemy_set_pieces()
+
+    def test_tree_is_reused_after_own_move(self):
+        event = self.gog.move((2, 0), (3, 0), 1)
+        self.ai.board_event((event[0][2], event[1]))
+        self.assertIsNone(self.ai._tree._root)
+        move = self.ai.get_move()
+        self.assertIn(move, _generate_valid_moves(self.ai._pov, 2))
+        root = self.ai._tree._root
+        event = self.gog.move(move[0], move[1], 2)
+        self.ai.board_event((event[0][2], event[1]))
+        self.assertIs(self.ai._tree._root, root.children[(tuple(square_index(x) for x in move), None)])
+        self.assertEqual(self.ai._tree._root.player, 1)
+
+    def tearDown(self) -> None:
+        self.gog = None
+        self.ai = None
+
+
+class ExpectiminimaxTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.gog = GOG()
+        self.gog.set_player_pieces(initial_pos_one, 1)
+        self.ai = AISmart(2, search='expectiminimax')
+        self.ai.set_pov(self.gog.set_player_pieces(initial_pos_two, 2))
+        self.ai.enemy_set_pieces()
+
+    def test_captures_known_flag(self):
+        pov = self.ai._pov
+        pov[4][3], pov[2][3] = pov[2][3], None
+        self.assertTrue(self.ai._beliefs.piece_is(pov[5][3].id - self.ai._enemy_base, FLG))
+        self.assertEqual(self.ai.get_move(), ((4, 3), (5, 3)))
+
+    def test_search_restores_state(self):
+        pov = self.ai._pov
+        pov[4][3], pov[2][3] = pov[2][3], None
+        search = AISmart.Expectiminimax(pov, 2, self.ai._beliefs, max_depth=3)
+        self.assertEqual(search.depth, 3)
+        self.assertIn(search.get_move(), _generate_valid_moves(pov, 2))
+        self.assertListEqual(search._pov, pov)
+        self.assertEqual(search._occupied, {p: _occupied_squares(pov, p) for p in (1, 2)})
+        self.assertListEqual(search._beliefs.ranks, self.ai._beliefs.ranks)
+        self.assertGreater(search._table.hits, 0)
+        # the squares of both players follow every outcome of a challenge
+        for outcome in (WIN, DRAW, LOSS):
+            undo = search._make(((4, 3), (5, 3)), outcome)
+            self.assertEqual(search._occupied, {p: _occupied_squares(search._pov, p) for p in (1, 2)})
+            search._unmake(undo)
+
+    def test_deadline(self):
+        search = AISmart.Expectiminimax(self.ai._pov, 2, self.ai._beliefs, deadline=time.time() + 0.2)
+        self.assertGreaterEqual(search.depth, 1)
+        self.assertIn(search.get_move(), _generate_valid_moves(self.ai._pov, 2))
+
+    def tearDown(self) -> None:
+        self.gog = None
+        self.ai = None
+
+
+class HeadlessTest(unittest.TestCase):
+    def test_engine_does_not_import_pygame(self):
+        code = 'import sys, main, arena, bench; sys.exit("pygame" in sys.modules)'
+        self.assertEqual(subprocess.run([sys.executable, '-c', code]).returncode, 0)
+
+
+class AIWorkerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.moves = Queue()
+        self.worker = None
+
+    def _start(self, **kwargs):
+        self.worker = AIWorker(AISmart, 2, on_move=self.moves.put, **kwargs)
+        self.gog = GOG()
+        self.worker.set_pov(self.gog.set_player_pieces(self.worker.get_init_form(), 2))
+        self.gog.set_player_pieces(initial_pos_one, 1)
+        self.worker.enemy_set_pieces()
+
+    def test_move_is_delivered(self):
+        self._start()
+        event = self.gog.move((2, 0), (3, 0), 1)
+        self.worker.board_event((event[0][2], event[1]))
+        self.worker.request_move()
+        move = self.moves.get(timeout=30)
+        self.assertFalse(self.worker.thinking)
+        self.assertIsNotNone(self.gog.move(move[0], move[1], 2))
+
+    def test_close_cancels_search(self):
+        self._start(playouts=None, time_limit=60)
+        self.worker.request_move()
+        start = time.time()
+        self.worker.close()
+        self.assertLess(time.time() - start, 10)
+        self.assertFalse(self.worker._process.is_alive())
+        self.assertTrue(self.moves.empty())
+
+    def test_worker_that_died_fails(self):
+        # the AI cannot be made, so the worker process ends right away
+        self.worker = AIWorker(AISmart, 2, search='none')
+        with self.assertRaises(RuntimeError):
+            self.worker.get_init_form()
+
+    def tearDown(self) -> None:
+        self.worker.close()
+        self.worker = None
+        self.gog = None
+
+
+def play_random_game(seed):
+    rng = Random(seed)
+    gog = GOG()
+    for player in [1, 2]:
+        gog.set_player_pieces(generate_random_init_form(), player)
+    positions = []
+    while not gog.victor:
+        valid_moves = generate_valid_moves(CompactBoardManager.from_board(gog.board).squares, gog.current_turn)
+        if not valid_moves:
+            break
+        move = [square_pos(square) for square in rng.choice(valid_moves)]
+        if gog.current_turn == 2:
+            move = [inv(pos) for pos in move]
+        assert gog.move(move[0], move[1], gog.current_turn)
+        positions.append(CompactBoardManager.from_board(gog.board).squares)
+    return gog, positions
+
+
+class GameRecordTest(unittest.TestCase):
+    def test_positions_follow_the_game(self):
+        for seed in range(5):
+            gog, positions = play_random_game(seed)
+            record = GameRecord.from_gog(gog)
+            self.assertEqual(len(record), len(positions))
+            self.assertListEqual([bytes(squares) for squares in record.positions()],
+                                 [bytes(squares) for squares in positions])
+            self.assertEqual(record.replay().victor, gog.victor)
+            self.assertEqual(record.replay(3).squares, positions[2])
+
+    def test_file_round_trip(self):
+        records = [GameRecord.from_gog(play_random_game(seed)[0]) for seed in range(3)]
+        f = BytesIO()
+        writer = RecordWriter(f)
+        for record in records:
+            writer.write(record)
+        f.seek(0)
+        read = list(read_records(f))
+        self.assertEqual(len(read), len(records))
+        for a, b in zip(read, records):
+            self.assertEqual(a.moves, b.moves)
+            self.assertEqual(a.victor, b.victor)
+            self.assertListEqual(a.formations[1], b.formations[1])
+            self.assertListEqual(a.formations[2], b.formations[2])
+
+    def test_rejects_other_files(self):
+        with self.assertRaises(ValueError):
+            list(read_records(BytesIO(b'not a record')))
+
+
+class OpeningBookTest(unittest.TestCase):
+    def test_file_round_trip(self):
+        entries = [(generate_random_init_form(), 0.5), (generate_random_init_form(), 0.25)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'book.txt')
+            book.save(entries, path)
+            self.assertEqual(book.load(path), entries)
+        self.assertEqual(book.load(os.path.join(directory, 'book.txt')), [])
+
+    def test_sampled_formations_are_valid(self):
+        for _ in range(10):
+            gog = GOG()
+            gog.set_player_pieces(AISmart(1).get_init_form(), 1)
+
+    def test_swap_keeps_the_pieces(self):
+        rng = Random(3)
+        start = generate_random_init_form(rng)
+        swapped = formation.swap(start, rng)
+        self.assertNotEqual(swapped, start)
+        self.assertEqual(Counter(x for row in swapped for x in row), Counter(x for row in start for x in row))
+
+    @unittest.skipIf(batch is None, 'numpy is not installed')
+    def test_scores(self):
+        rng = Random(4)
+        candidates = [generate_random_init_form(rng) for _ in range(2)]
+        opponents = [generate_random_init_form(rng) for _ in range(4)]
+        scores = formation.score_formations(candidates, opponents, 0, max_plies=50)
+        self.assertEqual(len(scores), 2)
+        self.assertTrue(all(0 <= score <= 1 for score in scores))
+        self.assertEqual(scores, formation.score_formations(candidates, opponents, 0, max_plies=50))
+
+
+class ArenaTest(unittest.TestCase):
+    def test_report(self):
+        report = arena.run('random', 'random', 4, max_plies=50)
+        self.assertEqual(report['games'], 4)
+        self.assertEqual(report['draws'] + report['engines']['one']['wins'] + report['engines']['two']['wins'], 4)
+        self.assertGreater(report['engines']['one']['moves'], 0)
+
+    def test_game_is_reproducible(self):
+        self.assertEqual(arena.play_game(('random', 'random'), 5)['plies'],
+                         arena.play_game(('random', 'random'), 5)['plies'])
+
+
+class BenchTest(unittest.TestCase):
+    def test_regressions(self):
+        baseline = {'results': {'a': {'median_s': 1.0}, 'b': {'median_s': 1.0}}}
+        current = {'results': {'a': {'median_s': 1.1}, 'b': {'median_s': 1.5}, 'c': {'median_s': 9.0}}}
+        self.assertEqual(bench.regressions(current, baseline, 0.2), {'b': 1.5})
+
+    def test_micro_benchmarks(self):
+        results = bench.micro_benchmarks(0, 1)
+        self.assertIn('board_manager_move', results)
+        self.assertGreater(results['generate_valid_moves']['median_s'], 0)
+
+    def test_rollout_benchmarks(self):
+        results = bench.rollout_benchmarks(0, 1, playouts=5)
+        for name in ROLLOUT_POLICIES:
+            self.assertGreater(results['playout_%s_ply_0' % name]['average_plies'], 0)
+            self.assertLessEqual(results['playout_%s_cutoff_ply_0' % name]['longest_plies'], 80)
+
+
+
+class ServerTest(unittest.TestCase):
+    # plays through a local client and returns every message the server sent
+    def _play(self, requests, engine='random', until=lambda message: True):
+        async def play():
+            server = GameServer(engine, threads=2)
+            port = await server.start()
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            messages = []
+            try:
+                for request in requests:
+                    writer.write(json.dumps(request).encode() + b'\n')
+                    await writer.drain()
+                    # every request is answered or pushes an event, and the AI may move after it
+                    messages.append(json.loads(await asyncio.wait_for(reader.readline(), 10)))
+                    if messages[-1].get('player') == 1 and messages[-1]['type'] == 'event' and \
+                            not messages[-1]['victor']:
+                        messages.append(json.loads(await asyncio.wait_for(reader.readline(), 10)))
+                while messages and not until(messages[-1]):
+                    messages.append(json.loads(await asyncio.wait_for(reader.readline(), 10)))
+            finally:
+                writer.close()
+                await server.close()
+            return messages
+
+        return asyncio.run(play())
+
+    def test_game(self):
+        new_game = {'type': 'new_game', 'formation': book.format_formation(initial_pos_one)}
+        messages = self._play([new_game, {'type': 'move', 'game': 1, 'from': [2, 0], 'to': [3, 0]}])
+        self.assertEqual(messages[0]['type'], 'started')
+        self.assertEqual(messages[0]['board'][2][0], 'PRIVATE')
+        self.assertEqual(sum(x == '?' for row in messages[0]['board'] for x in row), 21)
+        self.assertEqual(messages[1], {'type': 'event', 'game': 1, 'player': 1, 'move': [[2, 0], [3, 0]],
+                                       'outcome': 'none', 'victor': 0})
+        self.assertEqual((messages[2]['type'], messages[2]['player']), ('event', 2))
+
+    def test_ai_moves_first(self):
+        messages = self._play([{'type': 'new_game', 'engine': 'monte_carlo', 'player': 2}],
+                              until=lambda message: message['type'] == 'event')
+        self.assertEqual([message['type'] for message in messages], ['started', 'event'])
+        self.assertEqual(messages[1]['player'], 1)
+
+    def test_errors(self):
+        messages = self._play([
+            {'type': 'new_game', 'formation': 'x' * 27},
+            {'type': 'new_game', 'engine': 'none'},
+            {'type': 'move', 'game': 7, 'from': [2, 0], 'to': [3, 0]},
+            {'type': 'new_game', 'formation': book.format_formation(initial_pos_one)},
+            {'type': 'move', 'game': 1, 'from': [2, 0], 'to': [4, 0]},
+            'move',
+        ])
+        self.assertEqual([message['type'] for message in messages], ['error'] * 3 + ['started'] + ['error'] * 2)
+        self.assertEqual(messages[2]['message'], 'no such game')
+        self.assertEqual(messages[4], {'type': 'error', 'game': 1, 'message': 'invalid move'})
+
+    def test_ai_failure_is_reported(self):
+        with mock.patch.object(AIRandom, 'get_move', side_effect=RuntimeError('no search')):
+            messages = self._play([{'type': 'new_game', 'player': 2}],
+                                  until=lambda message: message['type'] == 'error')
+        self.assertEqual(messages[1], {'type': 'error', 'game': 1, 'message': 'the AI failed: no search'})
+
+    @unittest.skipIf(batch is None, 'numpy is not installed')
+    def test_batched_games(self):
+        async def play():
+            server = GameServer('batch', batch=True)
+            port = await server.start()
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(json.dumps({'type': 'new_game', 'engine': 'monte_carlo'}).encode() + b'\n')
+            for _ in range(3):
+                writer.write(json.dumps({'type': 'new_game', 'player': 2}).encode() + b'\n')
+            messages = [json.loads(await asyncio.wait_for(reader.readline(), 10)) for _ in range(7)]
+            writer.close()
+            await server.close()
+            return messages
+
+        messages = asyncio.run(play())
+        self.assertEqual(messages[0]['message'], 'the server only plays the batch engine')
+        self.assertEqual(Counter(message['type'] for message in messages), {'error': 1, 'started': 3, 'event': 3})
+        with self.assertRaises(ValueError):
+            GameServer('monte_carlo', batch=True)
+
 if __name__ == 'main':
     unittest.main()
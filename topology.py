@@ -0,0 +1,34 @@
+ROWS = 8
+COLS = 9
+SQUARES = ROWS * COLS
+# the order in which move generation tries the neighbors of a square
+DIRECTIONS = ((0, 1), (1, 0), (-1, 0), (0, -1))
+# STEPS[d] is the square index offset of direction d
+STEPS = tuple(dr * COLS + dc for dr, dc in DIRECTIONS)
+
+
+# squares are numbered row by row from (0, 0), so index = row * COLS + col
+def square_index(pos):
+    return pos[0] * COLS + pos[1]
+
+
+def square_pos(index):
+    return divmod(index, COLS)
+
+
+def mirror_square(index):
+    row, col = divmod(index, COLS)
+    return row * COLS + COLS - 1 - col
+
+
+# NEIGHBORS[i] are the squares next to square i, in DIRECTIONS order
+NEIGHBORS = []
+for _i in range(SQUARES):
+    _r, _c = square_pos(_i)
+    NEIGHBORS.append(tuple(square_index((_r + dr, _c + dc)) for dr, dc in DIRECTIONS
+                           if 0 <= _r + dr < ROWS and 0 <= _c + dc < COLS))
+# NEIGHBOR_POSITIONS[row][col] are the positions next to (row, col), in DIRECTIONS order, for boards of rows
+NEIGHBOR_POSITIONS = [[tuple(square_pos(n) for n in NEIGHBORS[square_index((r, c))]) for c in range(COLS)]
+                      for r in range(ROWS)]
+# ADJACENT[pos] is the set of positions next to pos; positions off the board are not keys
+ADJACENT = {square_pos(i): frozenset(square_pos(n) for n in NEIGHBORS[i]) for i in range(SQUARES)}
@@ -0,0 +1,123 @@
+import queue
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from threading import Thread
+
+from gog import BoardManager
+
+
+# runs in the worker process, which owns the AI and its own copy of the AI's point of view
+def _serve(ai_class, args, kwargs, connection):
+    ai = ai_class(*args, **kwargs)
+    pov = None
+    board_manager = None
+    while True:
+        request = connection.recv()
+        if request[0] == 'close':
+            break
+        elif request[0] == 'get_init_form':
+            connection.send(('init_form', ai.get_init_form()))
+        elif request[0] == 'set_pov':
+            pov = request[1]
+            ai.set_pov(pov)
+        elif request[0] == 'enemy_set_pieces':
+            # the enemy pieces were placed in the UI process after set_pov
+            pov[:] = request[1]
+            board_manager = BoardManager(pov)
+            ai.enemy_set_pieces()
+        elif request[0] == 'board_event':
+            move = request[1]
+            ai.board_event((move, board_manager.move(move)))
+        elif request[0] == 'get_move':
+            connection.send(('move', request[1], ai.get_move()))
+    if hasattr(ai, 'close'):
+        ai.close()
+
+
+# an AI running in a separate process. Moves are requested with request_move and handed to on_move from a
+# listener thread once they are ready, so nothing in the caller's process waits or spins while the AI thinks.
+class AIWorker:
+    def __init__(self, ai_class, *args, on_move=None, **kwargs):
+        # spawn gives the worker a clean interpreter without the UI's display or pygame state
+        context = get_context('spawn')
+        self._connection, worker_connection = context.Pipe()
+        self._process = context.Process(target=_serve, args=(ai_class, args, kwargs, worker_connection), daemon=True)
+        self._process.start()
+        worker_connection.close()
+        self.on_move = on_move
+        self._pov = None
+        # only the answer to the latest move request is delivered
+        self._request_id = 0
+        self._thinking = False
+        self._replies = queue.Queue()
+        self._listener = Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    # returns once the worker process has ended, and wakes up anyone still waiting for a reply
+    def _listen(self):
+        while True:
+            wait([self._connection, self._process.sentinel])
+            try:
+                result = self._connection.recv()
+            except (EOFError, OSError):
+                self._replies.put(None)
+                return
+            if result[0] == 'move':
+                if result[1] == self._request_id and self._thinking:
+                    self._thinking = False
+                    if self.on_move:
+                        self.on_move(result[2])
+            else:
+                self._replies.put(result[1])
+
+    @property
+    def thinking(self):
+        return self._thinking
+
+    def set_pov(self, pov):
+        self._pov = pov
+        self._connection.send(('set_pov', pov))
+
+    def get_init_form(self):
+        try:
+            self._connection.send(('get_init_form',))
+        except OSError as e:
+            raise RuntimeError('the AI worker process has ended') from e
+        init_form = self._replies.get()
+        if init_form is None:
+            raise RuntimeError('the AI worker process has ended')
+        return init_form
+
+    def enemy_set_pieces(self):
+        assert self._pov
+        self._connection.send(('enemy_set_pieces', self._pov))
+
+    # only the move is sent; the worker works out the eliminated pieces on its own copy of the board
+    def board_event(self, event):
+        if not event: return
+        self._connection.send(('board_event', event[0]))
+
+    def request_move(self):
+        self._request_id += 1
+        self._thinking = True
+        self._connection.send(('get_move', self._request_id))
+
+    # the move of the search in flight, if any, is dropped when it arrives
+    def cancel(self):
+        self._request_id += 1
+        self._thinking = False
+
+    # a search in flight is stopped by ending the worker process
+    def close(self):
+        if self._process.is_alive():
+            if self._thinking:
+                self._process.terminate()
+            else:
+                try:
+                    self._connection.send(('close',))
+                except OSError:
+                    # the process is ending on its own
+                    pass
+            self._process.join()
+        self.cancel()
+        self._listener.join()
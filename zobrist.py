@@ -0,0 +1,104 @@
+from random import Random
+
+from topology import SQUARES, mirror_square
+# square codes are player << 4 | rank, so they stay below 48; rank 15 never occurs and stands for a hidden piece
+CODES = 3 << 4
+HIDDEN = 0xf
+
+FULL_VIEW = 0
+
+
+def mirror_move(move):
+    return mirror_square(move[0]), mirror_square(move[1])
+
+
+_random = Random(0x60760760)
+_base = [[0] + [_random.getrandbits(64) for _ in range(CODES - 1)] for _ in range(SQUARES)]
+TURN_KEY = _random.getrandbits(64)
+WINNING_KEYS = [0, _random.getrandbits(64), _random.getrandbits(64)]
+
+
+def _view(player):
+    if player == FULL_VIEW:
+        return _base
+    # the other player's pieces hash the same whatever their rank, which gives the hash of an information set
+    hidden = 1 if player == 2 else 2
+    return [[row[code] if code >> 4 != hidden else row[hidden << 4 | HIDDEN] for code in range(CODES)]
+            for row in _base]
+
+
+# KEYS[view][square][code]: view 0 sees every rank, view p only sees the ranks of player p
+KEYS = [_view(view) for view in range(3)]
+MIRROR_KEYS = [[keys[mirror_square(square)] for square in range(SQUARES)] for keys in KEYS]
+
+
+def hash_squares(squares, keys):
+    h = 0
+    for index, code in enumerate(squares):
+        h ^= keys[index][code]
+    return h
+
+
+class _Entry:
+    def __init__(self, key, value, visits, best_move, depth, generation):
+        self.key = key
+        self.value = value
+        self.visits = visits
+        self.best_move = best_move
+        self.depth = depth
+        self.generation = generation
+
+
+# fixed size table indexed by the low bits of the hash. A position and its left-right mirror share one entry,
+# stored under the smaller of the two hashes with the best move in that orientation.
+class TranspositionTable:
+    def __init__(self, bits=16):
+        self._mask = (1 << bits) - 1
+        self._table = [None] * (1 << bits)
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return sum(1 for entry in self._table if entry is not None)
+
+    # entries from earlier searches are the first to be replaced
+    def new_search(self):
+        self._generation += 1
+
+    @staticmethod
+    def _canonical(key, mirror_key):
+        if mirror_key is not None and mirror_key < key:
+            return mirror_key, True
+        return key, False
+
+    # returns the entry and whether its best move has to be mirrored for the position that was looked up
+    def probe(self, key, mirror_key=None):
+        canonical, mirrored = self._canonical(key, mirror_key)
+        entry = self._table[canonical & self._mask]
+        if entry is None or entry.key != canonical:
+            self.misses += 1
+            return None, False
+        self.hits += 1
+        entry.generation = self._generation
+        return entry, mirrored
+
+    def best_move(self, key, mirror_key=None):
+        entry, mirrored = self.probe(key, mirror_key)
+        if entry is None or entry.best_move is None:
+            return None
+        return mirror_move(entry.best_move) if mirrored else entry.best_move
+
+    # keeps the deeper (or more visited) of two different positions from the current search
+    def store(self, key, mirror_key=None, value=None, visits=0, best_move=None, depth=0):
+        canonical, mirrored = self._canonical(key, mirror_key)
+        slot = canonical & self._mask
+        old = self._table[slot]
+        if old is not None and old.key != canonical and old.generation == self._generation \
+                and (old.depth, old.visits) > (depth, visits):
+            return None
+        if mirrored and best_move is not None:
+            best_move = mirror_move(best_move)
+        entry = _Entry(canonical, value, visits, best_move, depth, self._generation)
+        self._table[slot] = entry
+        return entry